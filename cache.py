@@ -0,0 +1,105 @@
+# cache.py
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Directory for on-disk caches
+CACHE_DIR = os.getenv('CACHE_DIR', 'cache')
+CACHE_DB_PATH = os.path.join(CACHE_DIR, 'cache.sqlite3')
+
+class TTLCache:
+    # Thread-safe LRU cache whose entries expire ttl seconds after they were set
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+_MISSING = object()
+
+class PersistentCache:
+    # JSON values in a SQLite table with per-entry expiry, so entries survive restarts.
+    # With maxsize set, the least recently used entries are evicted beyond that many.
+    def __init__(self, table, ttl, path=CACHE_DB_PATH, maxsize=None):
+        self.table = table
+        self.ttl = ttl
+        self.maxsize = maxsize
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL DEFAULT 0)"
+            )
+            columns = [row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")]
+            if 'accessed_at' not in columns:
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            value, expires_at = row
+            with self._conn:
+                if expires_at < now:
+                    self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                    return default
+                if self.maxsize is not None:
+                    self._conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now)
+            )
+            if self.maxsize is not None:
+                self._conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.maxsize,)
+                )
@@ -0,0 +1,17 @@
+# concurrency.py
+
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# Bounded pool for blocking work (HTTP calls made with requests, spaCy, python-docx)
+# so it never runs on the event loop
+BLOCKING_POOL_SIZE = int(os.getenv('BLOCKING_POOL_SIZE', 32))
+
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE, thread_name_prefix='blocking')
+
+async def run_blocking(func, *args, **kwargs):
+    # Run a blocking function in the shared pool and await its result
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
@@ -1,12 +1,15 @@
 # embeddings.py
 
 import os
+import json
+import hashlib
 import openai
 import numpy as np
 import logging
+import threading
 from dotenv import load_dotenv
-from helpers import read_word_doc
-import os
+from helpers import read_word_doc_paragraphs
+from concurrency import run_blocking
 
 # Load environment variables
 load_dotenv()
@@ -14,60 +17,291 @@ load_dotenv()
 # Set OpenAI API key
 openai.api_key = os.getenv('OPENAI_API_KEY')
 
-def create_embeddings_for_docs():
-    folder_path = "static/files"
-    doc_embeddings = []
-    filenames = []
+# Folder containing the Word documents and location of the persisted index
+DOCS_FOLDER = "static/files"
+INDEX_DIR = os.getenv('EMBEDDINGS_INDEX_DIR', 'cache')
+EMBEDDINGS_PATH = os.path.join(INDEX_DIR, 'doc_embeddings.npy')
+MANIFEST_PATH = os.path.join(INDEX_DIR, 'doc_manifest.json')
+INDEX_VERSION = 3
 
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".docx"):
-            filepath = os.path.join(folder_path, filename)
-            doc_content = read_word_doc(filepath)
-            embedding = get_embedding(doc_content)
-            logging.info(f"Created embedding for {filename}")  # Log the embedding creation
-            doc_embeddings.append(embedding)
-            filenames.append(filepath)
+# Dimension of text-embedding-ada-002 vectors
+EMBEDDING_DIM = 1536
 
-    return doc_embeddings, filenames
+# Chunking settings (in words). Chunks stay well below the embedding model's input limit.
+CHUNK_MAX_WORDS = int(os.getenv('CHUNK_MAX_WORDS', 250))
+CHUNK_OVERLAP_WORDS = int(os.getenv('CHUNK_OVERLAP_WORDS', 50))
 
-def get_embedding(text):
-    response = openai.Embedding.create(
+# Retrieval settings
+SIMILARITY_THRESHOLD = 0.84  # Best chunk must score at least this to answer from the documents
+SUPPORTING_CHUNK_THRESHOLD = 0.80  # Other top chunks are included if they score at least this
+CHUNK_TOP_K = 4
+
+# In-memory copy of the index, loaded once and reused by every request.
+# Rows are L2-normalized float32 chunk vectors stored in one contiguous matrix,
+# and chunks[i] describes row i. Both are published together as one (matrix, chunks)
+# tuple, so a rebuild in another thread can never pair a new matrix with old chunks.
+_doc_index = None
+
+# Serializes index builds (startup, /reload_docs, first search) so they never write the files concurrently
+_index_build_lock = threading.Lock()
+
+def file_hash(filepath):
+    # SHA-256 of the file content, used to detect changed documents
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def is_heading(style_name):
+    return style_name.startswith('Heading') or style_name == 'Title'
+
+def split_long_paragraph(text, max_words):
+    words = text.split()
+    return [' '.join(words[i:i + max_words]) for i in range(0, len(words), max_words)]
+
+def trailing_words(paragraphs, num_words):
+    # The last num_words words of a window, keeping the paragraph breaks between them
+    tail = []
+    for paragraph in reversed(paragraphs):
+        if num_words <= 0:
+            break
+        words = paragraph.split()
+        tail.insert(0, ' '.join(words[-num_words:]))
+        num_words -= len(words)
+    return tail
+
+def chunk_document(paragraphs, max_words=CHUNK_MAX_WORDS, overlap_words=CHUNK_OVERLAP_WORDS):
+    # Group paragraphs into heading-aware windows of at most max_words, with overlap.
+    # A heading always starts a new section and is repeated at the top of its chunks.
+    # Each chunk starts with the last overlap_words words of the previous one, and long
+    # paragraphs are cut into pieces of max_words - overlap_words so that overlap always fits.
+    piece_words = max(1, max_words - overlap_words)
+    sections = []
+    current_heading = None
+    current_paragraphs = []
+    for style_name, text in paragraphs:
+        if is_heading(style_name):
+            if current_paragraphs:
+                sections.append((current_heading, current_paragraphs))
+            current_heading = text
+            current_paragraphs = []
+        else:
+            current_paragraphs.extend(split_long_paragraph(text, piece_words))
+    if current_paragraphs or current_heading:
+        sections.append((current_heading, current_paragraphs))
+
+    chunks = []
+    for heading, section_paragraphs in sections:
+        if not section_paragraphs:
+            chunks.append({'heading': heading, 'text': heading})
+            continue
+
+        window = []
+        window_words = 0
+        for paragraph in section_paragraphs:
+            paragraph_words = len(paragraph.split())
+            if window and window_words + paragraph_words > max_words:
+                chunks.append({'heading': heading, 'text': format_chunk(heading, window)})
+                # Carry the trailing words over so context spans the chunk boundary
+                carried_words = min(overlap_words, window_words, max(0, max_words - paragraph_words))
+                window = trailing_words(window, carried_words)
+                window_words = carried_words
+            window.append(paragraph)
+            window_words += paragraph_words
+        if window:
+            chunks.append({'heading': heading, 'text': format_chunk(heading, window)})
+
+    return chunks
+
+def format_chunk(heading, paragraphs):
+    body = "\n".join(paragraphs)
+    return f"{heading}\n{body}" if heading else body
+
+def load_index():
+    # Load the persisted embedding matrix and its manifest from disk
+    if not (os.path.exists(EMBEDDINGS_PATH) and os.path.exists(MANIFEST_PATH)):
+        return None, []
+    try:
+        embeddings = np.load(EMBEDDINGS_PATH)
+        with open(MANIFEST_PATH, 'r') as f:
+            manifest = json.load(f)
+        if (not isinstance(manifest, dict) or manifest.get('version') != INDEX_VERSION
+                or manifest.get('chunk_max_words') != CHUNK_MAX_WORDS
+                or manifest.get('chunk_overlap_words') != CHUNK_OVERLAP_WORDS):
+            logging.info("Embedding index was built with different settings. Rebuilding.")
+            return None, []
+        documents = manifest.get('documents', [])
+        if sum(len(doc['chunks']) for doc in documents) != len(embeddings):
+            logging.warning("Embedding index and manifest are out of sync. Ignoring persisted index.")
+            return None, []
+        return embeddings, documents
+    except Exception as e:
+        logging.error(f"Error loading embedding index: {e}")
+        return None, []
+
+def save_index(embeddings, documents):
+    # Write to temporary files and rename them into place, so readers never see a partial index
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    with open(EMBEDDINGS_PATH + '.tmp', 'wb') as f:
+        np.save(f, embeddings)
+    manifest = {
+        'version': INDEX_VERSION,
+        'chunk_max_words': CHUNK_MAX_WORDS,
+        'chunk_overlap_words': CHUNK_OVERLAP_WORDS,
+        'documents': documents
+    }
+    with open(MANIFEST_PATH + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(EMBEDDINGS_PATH + '.tmp', EMBEDDINGS_PATH)
+    os.replace(MANIFEST_PATH + '.tmp', MANIFEST_PATH)
+
+def build_index():
+    # Build (or refresh) the chunk index, only re-embedding files whose content changed
+    with _index_build_lock:
+        return _build_index()
+
+def _build_index():
+    global _doc_index
+
+    previous_embeddings, previous_documents = load_index()
+    previous_by_filename = {}
+    row = 0
+    for entry in previous_documents:
+        previous_by_filename[entry['filename']] = (row, entry)
+        row += len(entry['chunks'])
+
+    chunk_embeddings = []
+    documents = []
+    changed = False
+
+    for filename in sorted(os.listdir(DOCS_FOLDER)):
+        if not filename.endswith(".docx"):
+            continue
+        filepath = os.path.join(DOCS_FOLDER, filename)
+        mtime = os.path.getmtime(filepath)
+        previous = previous_by_filename.get(filepath)
+
+        if previous and previous[1]['mtime'] == mtime:
+            # Unchanged since the last build, reuse the stored embeddings
+            content_hash = previous[1]['hash']
+            chunks = previous[1]['chunks']
+            embeddings = list(previous_embeddings[previous[0]:previous[0] + len(chunks)])
+        else:
+            content_hash = file_hash(filepath)
+            if previous and previous[1]['hash'] == content_hash:
+                # Touched but not modified, reuse the stored embeddings
+                chunks = previous[1]['chunks']
+                embeddings = list(previous_embeddings[previous[0]:previous[0] + len(chunks)])
+            else:
+                chunks = chunk_document(read_word_doc_paragraphs(filepath))
+                embeddings = get_embeddings([chunk['text'] for chunk in chunks]) if chunks else []
+                logging.info(f"Created {len(chunks)} chunk embeddings for {filename}")  # Log the embedding creation
+            changed = True
+
+        chunk_embeddings.extend(embeddings)
+        documents.append({'filename': filepath, 'mtime': mtime, 'hash': content_hash, 'chunks': chunks})
+
+    if len(documents) != len(previous_documents):
+        changed = True
+
+    if chunk_embeddings:
+        embeddings = np.array(chunk_embeddings, dtype=np.float32)
+    else:
+        # No documents (or no text in them): an empty index that matches nothing
+        embeddings = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+    if changed:
+        save_index(embeddings, documents)
+        logging.info(f"Saved embedding index with {len(embeddings)} chunks from {len(documents)} documents to {INDEX_DIR}")
+    else:
+        logging.info(f"Embedding index is up to date ({len(embeddings)} chunks from {len(documents)} documents).")
+
+    chunk_matrix = normalize_rows(embeddings)
+    chunks = [
+        {'filename': doc['filename'], 'heading': chunk['heading'], 'text': chunk['text']}
+        for doc in documents
+        for chunk in doc['chunks']
+    ]
+    _doc_index = (chunk_matrix, chunks)
+    return _doc_index
+
+async def aget_embedding(text):
+    # Non-blocking variant used on the request path
+    response = await openai.Embedding.acreate(
         input=[text],
         model="text-embedding-ada-002"
     )
     return response['data'][0]['embedding']
 
-def cosine_similarity(a, b):
-    a = np.array(a)
-    b = np.array(b)
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
-
-def find_most_relevant_doc(query_embedding, doc_embeddings, filenames):
-    similarities = []
-    for idx, doc_embedding in enumerate(doc_embeddings):
-        similarity = cosine_similarity(query_embedding, doc_embedding)
-        similarities.append(similarity)
-        logging.info(f"Similarity with {filenames[idx]}: {similarity}")  # Log similarity scores
-    most_similar_idx = np.argmax(similarities)
-    logging.info(f"Most similar document: {filenames[most_similar_idx]} with similarity {similarities[most_similar_idx]}")
-    return filenames[most_similar_idx], similarities[most_similar_idx]
-
-def search_all_docs(query):
-    # Create embeddings for documents (should be cached in production)
-    doc_embeddings, filenames = create_embeddings_for_docs()
-    # Get embedding for the query
-    query_embedding = get_embedding(query)
-    # Find the most relevant document
-    most_relevant_filename, similarity = find_most_relevant_doc(query_embedding, doc_embeddings, filenames)
-    logging.info(f"Most relevant document: {most_relevant_filename} with similarity {similarity}")
+def get_embeddings(texts):
+    # Embed several texts in a single API call, preserving input order
+    response = openai.Embedding.create(
+        input=texts,
+        model="text-embedding-ada-002"
+    )
+    data = sorted(response['data'], key=lambda item: item['index'])
+    return [item['embedding'] for item in data]
+
+def normalize_rows(matrix):
+    # L2-normalize each row so cosine similarity becomes a plain dot product
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    if matrix.size == 0:
+        return matrix
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def find_most_relevant_chunks(query_embedding, chunk_matrix, chunks, top_k=CHUNK_TOP_K):
+    # Rank chunks with a single matrix-vector product over the normalized matrix
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query_norm = np.linalg.norm(query)
+    if query_norm == 0 or len(chunks) == 0:
+        return []
+    scores = chunk_matrix @ (query / query_norm)
+
+    top_k = min(top_k, len(scores))
+    if top_k < len(scores):
+        top_idx = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        top_idx = np.arange(len(scores))
+    top_idx = top_idx[np.argsort(-scores[top_idx])]
 
-    # Set a similarity threshold
-    SIMILARITY_THRESHOLD = 0.84  # Adjust this threshold as needed
+    results = [(chunks[idx], float(scores[idx])) for idx in top_idx]
+    logging.info(f"Top {top_k} chunks: {[(chunk['filename'], score) for chunk, score in results]}")  # Log similarity scores
+    return results
+
+async def search_all_docs(query):
+    # Use the precomputed chunk index (built off the event loop if it is not loaded yet)
+    doc_index = _doc_index
+    if doc_index is None:
+        doc_index = await run_blocking(build_index)
+    chunk_matrix, chunks = doc_index
+    if not chunks:
+        logging.info("Document index is empty. No relevant document found.")
+        return None
+    # Get embedding for the query
+    query_embedding = await aget_embedding(query)
+    # Find the most relevant chunks
+    ranked_chunks = find_most_relevant_chunks(query_embedding, chunk_matrix, chunks)
+    if not ranked_chunks:
+        return None
+    best_chunk, similarity = ranked_chunks[0]
+    logging.info(f"Most relevant document: {best_chunk['filename']} with similarity {similarity}")
 
     if similarity < SIMILARITY_THRESHOLD:
         logging.info(f"Similarity {similarity} is below threshold {SIMILARITY_THRESHOLD}. No relevant document found.")
         return None  # No relevant content found
-    else:
-        # Read content from the most relevant document
-        relevant_content = read_word_doc(most_relevant_filename)
-        return relevant_content
+
+    # Only send the relevant excerpts to the model, not the whole documents
+    excerpts = []
+    for chunk, score in ranked_chunks:
+        if score < SUPPORTING_CHUNK_THRESHOLD:
+            break
+        title = os.path.splitext(os.path.basename(chunk['filename']))[0]
+        excerpts.append(f"From \"{title}\":\n{chunk['text']}")
+    return "\n\n---\n\n".join(excerpts)
+
+if __name__ == "__main__":
+    # Build the index from the command line: python embeddings.py
+    logging.basicConfig(level=logging.INFO)
+    build_index()
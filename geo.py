@@ -0,0 +1,142 @@
+# geo.py
+
+import math
+import numpy as np
+from collections import defaultdict
+from types import MappingProxyType
+
+EARTH_RADIUS_KM = 6371  # Radius of Earth in kilometers
+KM_PER_DEGREE_LAT = math.pi * EARTH_RADIUS_KM / 180
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM  # Half the circumference, the farthest two points can be
+
+def haversine_np(lat, lng, lats_rad, lngs_rad):
+    # Distances in km from one point (in degrees) to arrays of points (in radians), in one pass
+    lat1 = math.radians(lat)
+    lng1 = math.radians(lng)
+    dlat = lats_rad - lat1
+    dlng = lngs_rad - lng1
+    a = np.sin(dlat / 2)**2 + math.cos(lat1) * np.cos(lats_rad) * np.sin(dlng / 2)**2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def parse_coordinates(record):
+    # Return (lat, lng) for a POI record, or None when coordinates are missing or invalid
+    try:
+        lat = float(record.get('latitude', 0))
+        lng = float(record.get('longitude', 0))
+    except (TypeError, ValueError):
+        return None
+    if lat == 0 and lng == 0:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return lat, lng
+
+def freeze_records(records):
+    # Read-only views of API records, so cached data can be shared safely between requests
+    return [MappingProxyType(dict(record)) for record in records]
+
+class NearbyResult:
+    # Per-query view of a cached record and its distance; the record itself is never modified
+    __slots__ = ('record', 'distance')
+
+    def __init__(self, record, distance):
+        self.record = record
+        self.distance = distance
+
+class SpatialIndex:
+    # Grid index over POI records: each record is bucketed into a lat/lng cell of
+    # cell_size degrees, so a radius query only computes distances for records in
+    # the few cells that overlap the search circle. Coordinates are parsed once into
+    # NumPy arrays (radians) with a validity mask, and distances are computed in bulk.
+    def __init__(self, records, cell_size=0.25):
+        self.records = records
+        self.cell_size = cell_size
+        self._rows = int(math.ceil(180 / cell_size))
+        self._cols = int(math.ceil(360 / cell_size))
+
+        lats = np.zeros(len(records))
+        lngs = np.zeros(len(records))
+        self.valid = np.zeros(len(records), dtype=bool)
+        cell_members = defaultdict(list)
+        for idx, record in enumerate(records):
+            coords = parse_coordinates(record)
+            if coords is None:
+                continue
+            lats[idx], lngs[idx] = coords
+            self.valid[idx] = True
+            cell_members[self._cell(*coords)].append(idx)
+
+        self.lats_rad = np.radians(lats)
+        self.lngs_rad = np.radians(lngs)
+        self._cells = {cell: np.array(members, dtype=np.intp) for cell, members in cell_members.items()}
+
+    def __len__(self):
+        return int(self.valid.sum())
+
+    def _cell(self, lat, lng):
+        row = min(int((lat + 90) // self.cell_size), self._rows - 1)
+        col = int((lng + 180) // self.cell_size) % self._cols
+        return row, col
+
+    def _candidate_cells(self, lat, lng, radius_km):
+        # Cells overlapping the bounding box of the search circle
+        dlat = radius_km / KM_PER_DEGREE_LAT
+        min_row = max(0, int((lat - dlat + 90) // self.cell_size))
+        max_row = min(self._rows - 1, int((lat + dlat + 90) // self.cell_size))
+
+        max_abs_lat = min(abs(lat) + dlat, 90)
+        if max_abs_lat >= 89.9:
+            cols = None  # The circle reaches a pole, every longitude is in range
+        else:
+            dlng = radius_km / (KM_PER_DEGREE_LAT * math.cos(math.radians(max_abs_lat)))
+            if dlng >= 180:
+                cols = None
+            else:
+                min_col = int((lng - dlng + 180) // self.cell_size)
+                max_col = int((lng + dlng + 180) // self.cell_size)
+                cols = [col % self._cols for col in range(min_col, max_col + 1)]
+
+        num_candidates = (max_row - min_row + 1) * (self._cols if cols is None else len(cols))
+        if num_candidates > len(self._cells):
+            # Cheaper to filter the occupied cells than to enumerate the box
+            col_set = None if cols is None else set(cols)
+            return [
+                cell for cell in self._cells
+                if min_row <= cell[0] <= max_row and (col_set is None or cell[1] in col_set)
+            ]
+        return [
+            (row, col)
+            for row in range(min_row, max_row + 1)
+            for col in (range(self._cols) if cols is None else cols)
+            if (row, col) in self._cells
+        ]
+
+    def within_radius(self, lat, lng, radius_km, limit=None):
+        # Return NearbyResults within radius_km, nearest first (at most limit of them)
+        cells = self._candidate_cells(lat, lng, radius_km)
+        if not cells:
+            return []
+        candidates = np.concatenate([self._cells[cell] for cell in cells])
+        distances = haversine_np(lat, lng, self.lats_rad[candidates], self.lngs_rad[candidates])
+
+        in_radius = distances <= radius_km
+        candidates = candidates[in_radius]
+        distances = distances[in_radius]
+
+        if limit is not None and limit < len(distances):
+            # Select the nearest `limit` without sorting everything
+            top = np.argpartition(distances, limit - 1)[:limit]
+            candidates = candidates[top]
+            distances = distances[top]
+        order = np.argsort(distances, kind='stable')
+        return [NearbyResult(self.records[idx], float(distance)) for idx, distance in zip(candidates[order], distances[order])]
+
+    def nearest(self, lat, lng, k, max_radius_km=MAX_DISTANCE_KM):
+        # Return the k nearest NearbyResults, growing the search radius until enough are found
+        radius_km = max(self.cell_size * KM_PER_DEGREE_LAT, 1)
+        while True:
+            radius_km = min(radius_km, max_radius_km)
+            matches = self.within_radius(lat, lng, radius_km, limit=k)
+            if len(matches) >= k or radius_km >= max_radius_km:
+                return matches
+            radius_km *= 2
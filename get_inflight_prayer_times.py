@@ -1,7 +1,7 @@
 # get_inflight_prayer_times.py
 
 import os
-import requests
+import http_client
 import logging
 from dotenv import load_dotenv
 import urllib.parse
@@ -31,7 +31,7 @@ def get_inflight_prayer_times(departureAP, departureDateTime, arrivalAP, arrival
             'arrivalDateTime': arrivalDateTime
         }
 
-        response = requests.get(api_url, params=params, headers=headers)
+        response = http_client.get(api_url, params=params, headers=headers)
 
         if response.status_code == 200:
             data = response.json()
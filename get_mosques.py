@@ -1,11 +1,13 @@
 # get_mosques.py
 
 import os
-import requests
+import http_client
 import logging
 from dotenv import load_dotenv
 import time
-from math import radians, cos, sin, asin, sqrt
+import threading
+from geo import SpatialIndex, freeze_records
+from text_index import InvertedIndex
 import urllib.parse
 
 # Load environment variables
@@ -18,83 +20,63 @@ HALALTRIP_TOKEN = os.getenv('HALALTRIP_TOKEN')
 # Global variables for caching
 _cached_mosques_data = None
 _mosques_last_fetched = 0  # Timestamp of last fetch
+_mosques_spatial_index = None  # Built once per fetch for 'near me' queries
+_mosques_text_index = None  # Built once per fetch for area queries
+_mosques_refresh_lock = threading.Lock()  # Held by whichever thread is crawling the mosque list
 
-def haversine(lon1, lat1, lon2, lat2):
-    # Haversine formula
-    lon1, lat1, lon2, lat2 = map(
-        radians, [lon1, lat1, lon2, lat2])
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat / 2)**2 + cos(lat1) * \
-        cos(lat2) * sin(dlon / 2)**2
-    c = 2 * asin(sqrt(a))
-    r = 6371  # Radius of Earth in kilometers
-    return c * r
+def mosques_cache_is_fresh():
+    return _cached_mosques_data is not None and (time.time() - _mosques_last_fetched) < 86400
 
-def get_mosques(area=None, num_results=10, latitude=None, longitude=None, radius=5):
-    global _cached_mosques_data, _mosques_last_fetched
+def refresh_mosques():
+    # Crawl the mosque list and rebuild its indexes. The caller must hold _mosques_refresh_lock.
+    global _cached_mosques_data, _mosques_last_fetched, _mosques_spatial_index, _mosques_text_index
 
-    # Check if data is cached and if it's recent (e.g., within the last day)
     current_time = time.time()
-    if _cached_mosques_data is not None and (current_time - _mosques_last_fetched) < 86400:
-        all_mosques = _cached_mosques_data
+    logging.info("Fetching mosque data from API.")
+    api_url = f"http://api.halaltrip.com/v1/api/mosques"
+    headers = {
+        'APIKEY': HALALTRIP_API_KEY,
+        'TOKEN': HALALTRIP_TOKEN
+    }
+
+    # Fetch all pages concurrently, in order
+    all_mosques = freeze_records(http_client.fetch_all_pages(api_url, headers=headers, label='mosques'))
+
+    # Cache the data and index it by location and by name/address tokens
+    _mosques_spatial_index = SpatialIndex(all_mosques)
+    _mosques_text_index = InvertedIndex(all_mosques, {'area': ('name', 'address')})
+    _cached_mosques_data = all_mosques
+    _mosques_last_fetched = current_time
+
+def load_mosques():
+    # Return the cached mosques and their indexes, fetching them if they are missing or
+    # more than a day old. Only one request crawls the API; the others wait for it.
+    if mosques_cache_is_fresh():
         logging.info("Using cached mosque data.")
     else:
-        # Fetch data from API
-        try:
-            logging.info("Fetching mosque data from API.")
-            api_url = f"http://api.halaltrip.com/v1/api/mosques"
-            headers = {
-                'APIKEY': HALALTRIP_API_KEY,
-                'TOKEN': HALALTRIP_TOKEN
-            }
-
-            all_mosques = []
-            page = 1  # Start from the first page
-
-            while True:
-                params = {'page': page}
-                response = requests.get(api_url, params=params, headers=headers)
-
-                if response.status_code == 200:
-                    data = response.json()
-                    mosques = data.get('data', [])
-
-                    if not mosques:
-                        logging.info(f"No more mosques found at page {page}. Ending pagination.")
-                        break  # Stop if no more mosques
-
-                    logging.info(f"Fetched {len(mosques)} mosques from page {page}.")
-                    all_mosques.extend(mosques)
-                    page += 1  # Move to the next page
-
-                else:
-                    logging.error(f"Error fetching mosques on page {page}: {response.status_code} - {response.text}")
-                    return "Sorry, I couldn't fetch the list of mosques at the moment."
-
-            # Cache the data
-            _cached_mosques_data = all_mosques
-            _mosques_last_fetched = current_time
-
-        except Exception as e:
-            logging.error(f"Error fetching mosques: {e}")
-            return f"Error fetching mosques: {e}"
+        with _mosques_refresh_lock:
+            if mosques_cache_is_fresh():
+                logging.info("Using mosque data fetched by another request.")
+            else:
+                refresh_mosques()
+    return _cached_mosques_data, _mosques_spatial_index, _mosques_text_index
+
+def get_mosques(area=None, num_results=10, latitude=None, longitude=None, radius=5):
+    try:
+        all_mosques, spatial_index, text_index = load_mosques()
+    except http_client.PaginationError as e:
+        logging.error(f"Error fetching mosques on page {e.page}: {e}")
+        return "Sorry, I couldn't fetch the list of mosques at the moment."
+    except Exception as e:
+        logging.error(f"Error fetching mosques: {e}")
+        return f"Error fetching mosques: {e}"
 
     try:
         matches = []
 
         if latitude and longitude:
-            # Find mosques within the specified radius
-            for mosque in all_mosques:
-                mosque_lat = float(mosque.get('latitude', 0))
-                mosque_lon = float(mosque.get('longitude', 0))
-                distance = haversine(longitude, latitude, mosque_lon, mosque_lat)
-                if distance <= radius:
-                    mosque['distance'] = distance
-                    matches.append(mosque)
-
-            # Sort the matches by distance
-            matches.sort(key=lambda x: x['distance'])
+            # Find the nearest mosques within the specified radius using the spatial index
+            matches = spatial_index.within_radius(latitude, longitude, radius, limit=num_results)
 
             if not matches:
                 return f"No mosques found within {radius} km of your location."
@@ -102,10 +84,11 @@ def get_mosques(area=None, num_results=10, latitude=None, longitude=None, radius
             # Format the response
             response_text = f"**🕌 Here are some mosques within {radius} km of your location:**\n\n"
 
-            for i, mosque in enumerate(matches[:num_results]):
+            for i, result in enumerate(matches[:num_results]):
+                mosque = result.record
                 name = mosque.get('name', 'N/A').strip()
                 address = mosque.get('address', 'N/A').strip()
-                distance = mosque.get('distance', 0)
+                distance = result.distance
 
                 # Generate Google Maps link using coordinates
                 mosque_lat = float(mosque.get('latitude', 0))
@@ -126,17 +109,8 @@ def get_mosques(area=None, num_results=10, latitude=None, longitude=None, radius
             return response_text
 
         elif area:
-            # Existing area-based search logic
-            area_lower = area.lower()
-            area_keywords = area_lower.split()
-
-            for mosque in all_mosques:
-                address = mosque.get('address', '').lower()
-                name = mosque.get('name', '').lower()
-                combined_text = f"{name} {address}"
-
-                if all(keyword in combined_text for keyword in area_keywords):
-                    matches.append(mosque)
+            # Mosques whose name or address contains every area keyword
+            matches = text_index.search(area=area)
 
             # Remove duplicates
             matches = list({mosque['id']: mosque for mosque in matches}.values())
@@ -1,10 +1,15 @@
 # get_packages.py
 
 import requests
+import http_client
 import logging
 from dotenv import load_dotenv
 import os
 import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cache import TTLCache
 
 # Load environment variables
 load_dotenv()
@@ -13,45 +18,171 @@ load_dotenv()
 HALALTRIP_API_KEY = os.getenv('HALALTRIP_API_KEY')
 HALALTRIP_TOKEN = os.getenv('HALALTRIP_TOKEN')
 
-def get_all_packages():
+# Package catalog cache. Data older than PACKAGES_CACHE_TTL is still served while a
+# background refresh fetches the new catalog (stale-while-revalidate).
+PACKAGES_CACHE_TTL = int(os.getenv('PACKAGES_CACHE_TTL', 3600))
+
+# Global variables for caching
+_cached_packages_data = None
+_packages_by_id = {}
+_packages_last_fetched = 0  # Timestamp of last fetch
+_packages_last_failed = 0  # Timestamp of the last failed refresh
+_packages_lock = threading.Lock()
+# Held by whichever thread is refreshing the catalog, so only one crawl runs at a time
+_packages_refresh_lock = threading.Lock()
+
+# After a failed refresh, requests wait this long before triggering another crawl
+PACKAGES_REFRESH_BACKOFF = int(os.getenv('PACKAGES_REFRESH_BACKOFF', 60))
+
+# Fields get_package_by_id callers render; catalog records that have them are served from memory
+PACKAGE_DETAIL_FIELDS = ('name', 'description', 'prices')
+
+# Package detail payloads by id, for packages the catalog record cannot answer
+PACKAGE_DETAILS_CACHE_SIZE = int(os.getenv('PACKAGE_DETAILS_CACHE_SIZE', 1000))
+_package_details_cache = TTLCache(maxsize=PACKAGE_DETAILS_CACHE_SIZE, ttl=PACKAGES_CACHE_TTL)
+
+def fetch_all_packages():
     api_url = "http://api.halaltrip.com/v1/api/packages"
     headers = {
         'APIKEY': HALALTRIP_API_KEY,
         'TOKEN': HALALTRIP_TOKEN
     }
     try:
-        all_packages = []
-        page = 1
+        # Fetch all pages concurrently, in order
+        all_packages = http_client.fetch_all_pages(api_url, headers=headers, label='packages')
+        return all_packages
+
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error fetching packages: {e}")
+        return None
+
+def refresh_packages():
+    # Fetch the catalog and swap it in; on failure the previous catalog is kept and the
+    # failure time is recorded so requests back off. The caller must hold _packages_refresh_lock.
+    global _cached_packages_data, _packages_by_id, _packages_last_fetched, _packages_last_failed
+    try:
+        packages = fetch_all_packages()
+    except Exception as e:
+        logging.error(f"Unexpected error refreshing packages: {e}")
+        packages = None
+    if packages is None:
+        with _packages_lock:
+            _packages_last_failed = time.time()
+        return None
+    packages_by_id = {str(package.get('id')): package for package in packages}
+    with _packages_lock:
+        _cached_packages_data = packages
+        _packages_by_id = packages_by_id
+        _packages_last_fetched = time.time()
+    logging.info(f"Cached {len(packages)} packages.")
+    return packages
+
+def refresh_packages_if_idle():
+    # Refresh now unless another refresh is already running
+    if not _packages_refresh_lock.acquire(blocking=False):
+        return
+    try:
+        refresh_packages()
+    finally:
+        _packages_refresh_lock.release()
+
+def refresh_packages_in_background():
+    # Start a refresh thread unless one is already running
+    if not _packages_refresh_lock.acquire(blocking=False):
+        return
 
+    def run():
+        try:
+            refresh_packages()
+        finally:
+            _packages_refresh_lock.release()
+
+    try:
+        threading.Thread(target=run, name='packages-refresh', daemon=True).start()
+    except Exception:
+        _packages_refresh_lock.release()
+        raise
+
+def start_package_refresh(interval=PACKAGES_CACHE_TTL):
+    # Warm the catalog and keep it fresh from a daemon thread
+    def refresh_loop():
         while True:
-            params = {'page': page}
-            response = requests.get(api_url, headers=headers, params=params)
-            response.raise_for_status()
-            data = response.json()
-            packages = data.get('data', [])
+            try:
+                refresh_packages_if_idle()
+            except Exception as e:
+                logging.error(f"Error in package refresh loop: {e}")
+            time.sleep(interval)
 
-            if not packages:
-                logging.info(f"No more packages found at page {page}. Ending pagination.")
-                break  # No more packages to fetch
+    threading.Thread(target=refresh_loop, name='packages-refresh-loop', daemon=True).start()
 
-            logging.info(f"Fetched {len(packages)} packages from page {page}.")
-            all_packages.extend(packages)
-            page += 1  # Move to the next page
+def recently_failed():
+    # True while a failed refresh is within its backoff period
+    return (time.time() - _packages_last_failed) < PACKAGES_REFRESH_BACKOFF
 
-        return all_packages
+def get_all_packages():
+    # Serve the cached catalog, refreshing it in the background once it is stale
+    with _packages_lock:
+        packages = _cached_packages_data
+        is_stale = (time.time() - _packages_last_fetched) >= PACKAGES_CACHE_TTL
+        backing_off = recently_failed()
 
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching packages: {e}")
-        return None
+    if packages is None:
+        if backing_off:
+            logging.info("Package API failed recently. Not retrying yet.")
+            return None
+        # Wait for a refresh already in progress rather than starting a second crawl
+        with _packages_refresh_lock:
+            if _cached_packages_data is not None:
+                return _cached_packages_data
+            if recently_failed():
+                return None
+            logging.info("Fetching package data from API.")
+            return refresh_packages()
+
+    if is_stale and not backing_off:
+        logging.info("Package data is stale. Refreshing in the background.")
+        refresh_packages_in_background()
+    else:
+        logging.info("Using cached package data.")
+    return packages
 
 def get_package_by_id(package_id):
+    # Serve from the catalog when the cached record has everything callers render
+    with _packages_lock:
+        package = _packages_by_id.get(str(package_id))
+    if package and all(field in package for field in PACKAGE_DETAIL_FIELDS):
+        return package
+
+    package = _package_details_cache.get(str(package_id))
+    if package is not None:
+        logging.info(f"Using cached details for package {package_id}.")
+        return package
+
+    package = fetch_package_by_id(package_id)
+    if package:
+        _package_details_cache.set(str(package_id), package)
+    return package
+
+def prefetch_packages(package_ids, max_workers=8):
+    # Load the given packages into memory concurrently so follow-up questions need no upstream call
+    package_ids = list(dict.fromkeys(str(package_id) for package_id in package_ids))
+    if not package_ids:
+        return
+    logging.info(f"Prefetching {len(package_ids)} packages.")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(get_package_by_id, package_ids))
+
+def prefetch_packages_in_background(package_ids):
+    threading.Thread(target=prefetch_packages, args=(package_ids,), name='packages-prefetch', daemon=True).start()
+
+def fetch_package_by_id(package_id):
     url = f"http://api.halaltrip.com/v1/api/package/{package_id}"
     headers = {
         'APIKEY': HALALTRIP_API_KEY,
         'TOKEN': HALALTRIP_TOKEN
     }
     try:
-        response = requests.get(url, headers=headers)
+        response = http_client.get(url, headers=headers)
         response.raise_for_status()
         package = response.json().get('data', {})
         return package
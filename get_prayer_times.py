@@ -1,7 +1,7 @@
 # get_prayer_times.py
 
 import os
-import requests
+import http_client
 import logging
 from dotenv import load_dotenv
 from helpers import get_lat_long, get_timezone
@@ -15,11 +15,12 @@ HALALTRIP_API_KEY = os.getenv('HALALTRIP_API_KEY')
 HALALTRIP_TOKEN = os.getenv('HALALTRIP_TOKEN')
 
 import os
-import requests
+import http_client
 import logging
 from dotenv import load_dotenv
 from helpers import get_lat_long, get_timezone
 from datetime import datetime
+from cache import PersistentCache
 
 # Load environment variables
 load_dotenv()
@@ -28,23 +29,80 @@ load_dotenv()
 HALALTRIP_API_KEY = os.getenv('HALALTRIP_API_KEY')
 HALALTRIP_TOKEN = os.getenv('HALALTRIP_TOKEN')
 
-def get_prayer_times(city, country, specific_prayer=None, date=None):
+# Prayer times for a place and day never change, so they are cached on disk.
+# Coordinates are snapped to a grid of PRAYER_TIMES_GRID_DEGREES (about 5 km by default)
+# so nearby users share entries.
+PRAYER_TIMES_METHOD = 11  # MUIS calculation
+PRAYER_TIMES_GRID_DEGREES = float(os.getenv('PRAYER_TIMES_GRID_DEGREES', 0.05))
+PRAYER_TIMES_CACHE_TTL = int(os.getenv('PRAYER_TIMES_CACHE_TTL', 30 * 24 * 3600))
+_prayer_times_cache = PersistentCache('prayer_times', PRAYER_TIMES_CACHE_TTL)
+
+def snap_to_grid(value):
+    return round(round(float(value) / PRAYER_TIMES_GRID_DEGREES) * PRAYER_TIMES_GRID_DEGREES, 6)
+
+def prayer_times_cache_key(lat, lng, date_str, method=PRAYER_TIMES_METHOD):
+    return f"{lat},{lng},{date_str},{method}"
+
+def fetch_prayer_times(lat, lng, date_str, method=PRAYER_TIMES_METHOD):
+    # Fetch timings for the grid cell from HalalTrip and cache every day in the response.
+    # Returns the timings for date_str, or None if they could not be retrieved.
+    timezone = get_timezone(lat, lng)
+    if not timezone:
+        logging.error(f"Could not retrieve the timezone for {lat}, {lng}")
+        return None
+
+    api_url = "http://api.halaltrip.com/v1/api/prayertimes/"
+    headers = {
+        'APIKEY': HALALTRIP_API_KEY,
+        'TOKEN': HALALTRIP_TOKEN
+    }
+    params = {
+        'lat': lat,
+        'lng': lng,
+        'timeZoneId': timezone,
+        'date': date_str,
+        'method': method
+    }
+
+    response = http_client.get(api_url, params=params, headers=headers)
+    if response.status_code != 200:
+        logging.error(f"Error fetching prayer times: {response.status_code} - {response.text}")
+        return None
+
+    data = response.json()
+    logging.info(f"Response from Halaltrip API: {data}")
+
+    # Parse the data to get timings, keyed by date (e.g., '2024-12-05')
+    prayer_data = data.get('prayer', {})
+    if not prayer_data:
+        return None
+
+    for date_key, day_timings in prayer_data.items():
+        if day_timings and date_key != date_str:
+            _prayer_times_cache.set(prayer_times_cache_key(lat, lng, date_key, method), day_timings)
+    # Fall back to the first day in the response if it is not keyed by the requested date
+    timings = prayer_data.get(date_str) or prayer_data.get(next(iter(prayer_data)), {})
+    if timings:
+        _prayer_times_cache.set(prayer_times_cache_key(lat, lng, date_str, method), timings)
+    return timings or None
+
+def get_cached_prayer_times(lat, lng, date_str, method=PRAYER_TIMES_METHOD):
+    lat, lng = snap_to_grid(lat), snap_to_grid(lng)
+    timings = _prayer_times_cache.get(prayer_times_cache_key(lat, lng, date_str, method))
+    if timings:
+        logging.info(f"Using cached prayer times for {lat}, {lng} on {date_str}")
+        return timings
+    return fetch_prayer_times(lat, lng, date_str, method)
+
+def get_prayer_times(city, country, specific_prayer=None, date=None, lat=None, lng=None):
     try:
-        lat, lng = get_lat_long(city, country)
+        # Callers that already geocoded the location pass its coordinates in
+        if lat is None or lng is None:
+            lat, lng = get_lat_long(city, country)
         if not lat or not lng:
             return "Could not find the location."
 
-        timezone = get_timezone(lat, lng)
-        if not timezone:
-            return "Could not retrieve the timezone."
-
-        logging.info(f"Fetching prayer times for city: {city}, country: {country} in timezone {timezone}")
-
-        api_url = "http://api.halaltrip.com/v1/api/prayertimes/"
-        headers = {
-            'APIKEY': HALALTRIP_API_KEY,
-            'TOKEN': HALALTRIP_TOKEN
-        }
+        logging.info(f"Fetching prayer times for city: {city}, country: {country}")
 
         # Format the date for the API (YYYY-MM-DD)
         if date:
@@ -53,50 +111,26 @@ def get_prayer_times(city, country, specific_prayer=None, date=None):
             date = datetime.now()
             date_str = date.strftime('%Y-%m-%d')
 
-        params = {
-            'lat': lat,
-            'lng': lng,
-            'timeZoneId': timezone,
-            'date': date_str,
-            'method': 11  # Use method 11 for MUIS calculation
-        }
-
-        response = requests.get(api_url, params=params, headers=headers)
-
-        if response.status_code == 200:
-            data = response.json()
-            logging.info(f"Response from Halaltrip API: {data}")
-
-            # Parse the data to get timings
-            prayer_data = data.get('prayer', {})
-            if not prayer_data:
-                return "Could not retrieve prayer times."
-
-            # Get the date key (e.g., '2024-12-05')
-            date_key = next(iter(prayer_data))
-            timings = prayer_data.get(date_key, {})
-            if not timings:
-                return "Could not retrieve prayer times."
-
-            if specific_prayer:
-                specific_time = timings.get(specific_prayer.capitalize())
-                logging.info(f"Specific prayer time ({specific_prayer}) on {date_str}: {specific_time}")
-                return specific_time or f"{specific_prayer.capitalize()} time not available."
-            else:
-                formatted_timings = (
-                    f"**🕌 Here are the prayer times for {city}, {country} on {date_str}:**\n\n"
-                    f"**Fajr** ⏰: {timings.get('Fajr', 'N/A')}\n"
-                    f"**Sunrise** ⏰: {timings.get('Sunrise', 'N/A')}\n"
-                    f"**Dhuhr** ⏰: {timings.get('Dhuhr', 'N/A')}\n"
-                    f"**Asr** ⏰: {timings.get('Asr', 'N/A')}\n"
-                    f"**Maghrib** ⏰: {timings.get('Maghrib', 'N/A')}\n"
-                    f"**Isha** ⏰: {timings.get('Isha', 'N/A')}\n"
-                    f"\nFor more details, visit [HalalTrip Prayer Times](https://www.halaltrip.com/prayertimes/muslim-salat-prayer-times/)"
-                )
-                return formatted_timings
-        else:
-            logging.error(f"Error fetching prayer times: {response.status_code} - {response.text}")
+        timings = get_cached_prayer_times(lat, lng, date_str)
+        if not timings:
             return "Sorry, I couldn't fetch the prayer times at the moment."
+
+        if specific_prayer:
+            specific_time = timings.get(specific_prayer.capitalize())
+            logging.info(f"Specific prayer time ({specific_prayer}) on {date_str}: {specific_time}")
+            return specific_time or f"{specific_prayer.capitalize()} time not available."
+        else:
+            formatted_timings = (
+                f"**🕌 Here are the prayer times for {city}, {country} on {date_str}:**\n\n"
+                f"**Fajr** ⏰: {timings.get('Fajr', 'N/A')}\n"
+                f"**Sunrise** ⏰: {timings.get('Sunrise', 'N/A')}\n"
+                f"**Dhuhr** ⏰: {timings.get('Dhuhr', 'N/A')}\n"
+                f"**Asr** ⏰: {timings.get('Asr', 'N/A')}\n"
+                f"**Maghrib** ⏰: {timings.get('Maghrib', 'N/A')}\n"
+                f"**Isha** ⏰: {timings.get('Isha', 'N/A')}\n"
+                f"\nFor more details, visit [HalalTrip Prayer Times](https://www.halaltrip.com/prayertimes/muslim-salat-prayer-times/)"
+            )
+            return formatted_timings
     except Exception as e:
         logging.error(f"Error fetching prayer times: {e}")
         return f"Error fetching prayer times: {e}"
\ No newline at end of file
@@ -1,14 +1,18 @@
 # get_restaurants.py
 
 import os
-import requests
+import http_client
 import logging
 from dotenv import load_dotenv
 import time
-from math import radians, cos, sin, asin, sqrt
+import threading
+from geo import SpatialIndex, freeze_records
+from text_index import InvertedIndex, NameIndex
 import urllib.parse
 import re
-import difflib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from cache import TTLCache
 
 # Load environment variables
 load_dotenv()
@@ -20,27 +24,45 @@ HALALTRIP_TOKEN = os.getenv('HALALTRIP_TOKEN')
 # Global variables for caching
 _cached_restaurants_data = None
 _restaurants_last_fetched = 0  # Timestamp of last fetch
-
-def haversine(lon1, lat1, lon2, lat2):
-    # Haversine formula to calculate distance between two points on Earth
-    lon1, lat1, lon2, lat2 = map(
-        radians, [lon1, lat1, lon2, lat2])
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat / 2)**2 + cos(lat1) * \
-        cos(lat2) * sin(dlon / 2)**2
-    c = 2 * asin(sqrt(a))
-    r = 6371  # Radius of Earth in kilometers
-    return c * r
+_restaurants_spatial_index = None  # Built once per fetch for 'near me' queries
+_restaurants_text_index = None  # Built once per fetch for area and cuisine queries
+_restaurants_name_index = None  # Built once per fetch for restaurant detail queries
+_restaurants_refresh_lock = threading.Lock()  # Held by whichever thread is crawling the restaurant list
+
+# Restaurant detail payloads by id (LRU with TTL), and how often each id is asked for
+RESTAURANT_DETAILS_CACHE_TTL = int(os.getenv('RESTAURANT_DETAILS_CACHE_TTL', 86400))
+RESTAURANT_DETAILS_CACHE_SIZE = int(os.getenv('RESTAURANT_DETAILS_CACHE_SIZE', 2000))
+RESTAURANT_PREWARM_COUNT = int(os.getenv('RESTAURANT_PREWARM_COUNT', 50))
+_restaurant_details_cache = TTLCache(maxsize=RESTAURANT_DETAILS_CACHE_SIZE, ttl=RESTAURANT_DETAILS_CACHE_TTL)
+# Request counts are bounded to the busiest RESTAURANT_REQUEST_COUNTS_SIZE ids and halved
+# after every prewarm, so ids that stop being asked for fade out
+RESTAURANT_REQUEST_COUNTS_SIZE = int(os.getenv('RESTAURANT_REQUEST_COUNTS_SIZE', 1000))
+_restaurant_detail_requests = Counter()
+_restaurant_detail_requests_lock = threading.Lock()
+
+# Fields the detail reply renders; list records that have them need no detail request
+RESTAURANT_DETAIL_FIELDS = ('restaurantname', 'address', 'description')
+
+def restaurants_cache_is_fresh():
+    return _cached_restaurants_data is not None and (time.time() - _restaurants_last_fetched) < 86400
 
 def fetch_all_restaurants():
-    global _cached_restaurants_data, _restaurants_last_fetched
-
-    current_time = time.time()
-    if _cached_restaurants_data is not None and (current_time - _restaurants_last_fetched) < 86400:
+    if restaurants_cache_is_fresh():
         logging.info("Using cached restaurant data.")
         return _cached_restaurants_data
 
+    # Only one request crawls the API; the others wait for it and then use its result
+    with _restaurants_refresh_lock:
+        if restaurants_cache_is_fresh():
+            logging.info("Using restaurant data fetched by another request.")
+            return _cached_restaurants_data
+        return refresh_restaurants()
+
+def refresh_restaurants():
+    # Crawl the restaurant list and rebuild its indexes. The caller must hold _restaurants_refresh_lock.
+    global _cached_restaurants_data, _restaurants_last_fetched, _restaurants_spatial_index, _restaurants_text_index, _restaurants_name_index
+
+    current_time = time.time()
     try:
         logging.info("Fetching restaurant data from API.")
         api_url = f"http://api.halaltrip.com/v1/api/restaurants"
@@ -49,34 +71,26 @@ def fetch_all_restaurants():
             'TOKEN': HALALTRIP_TOKEN
         }
 
-        all_restaurants = []
-        page = 1  # Start from the first page
-
-        while True:
-            params = {'page': page}
-            response = requests.get(api_url, params=params, headers=headers)
-
-            if response.status_code == 200:
-                data = response.json()
-                restaurants = data.get('data', [])
+        # Fetch all pages concurrently, in order
+        all_restaurants = freeze_records(http_client.fetch_all_pages(api_url, headers=headers, label='restaurants'))
 
-                if not restaurants:
-                    logging.info(f"No more restaurants found at page {page}. Ending pagination.")
-                    break  # Stop if no more restaurants
+        # Cache the data and index it by location, by name/address tokens and by description (cuisine)
+        _restaurants_spatial_index = SpatialIndex(all_restaurants)
+        _restaurants_text_index = InvertedIndex(all_restaurants, {
+            'area': ('restaurantname', 'address'),
+            'cuisine': ('description',)
+        })
+        _restaurants_name_index = NameIndex(all_restaurants, 'restaurantname')
 
-                logging.info(f"Fetched {len(restaurants)} restaurants from page {page}.")
-                all_restaurants.extend(restaurants)
-                page += 1  # Move to the next page
-
-            else:
-                logging.error(f"Error fetching restaurants on page {page}: {response.status_code} - {response.text}")
-                return None
-
-        # Cache the data
+        # Refresh details of the most requested restaurants in the background
+        threading.Thread(target=prewarm_restaurant_details, name='restaurant-prewarm', daemon=True).start()
         _cached_restaurants_data = all_restaurants
         _restaurants_last_fetched = current_time
         return all_restaurants
 
+    except http_client.PaginationError as e:
+        logging.error(f"Error fetching restaurants on page {e.page}: {e}")
+        return None
     except Exception as e:
         logging.error(f"Error fetching restaurants: {e}")
         return None
@@ -87,29 +101,26 @@ def get_restaurant_by_name(restaurant_name):
         if all_restaurants is None:
             return "Sorry, I couldn't fetch the restaurant data at the moment."
 
+        name_index = _restaurants_name_index
+
         # First, check for exact matches
-        exact_matches = [restaurant for restaurant in all_restaurants if restaurant.get('restaurantname', '').strip().lower() == restaurant_name.lower()]
+        exact_matches = name_index.normalized(restaurant_name)
         if exact_matches:
             restaurant_id = exact_matches[0].get('id')
-            return get_restaurant_details(restaurant_id)
+            return get_restaurant_details(restaurant_id, record=exact_matches[0])
 
-        # If no exact matches, use fuzzy matching
-        restaurant_names = [restaurant.get('restaurantname', '').strip() for restaurant in all_restaurants]
-        close_matches = difflib.get_close_matches(restaurant_name.lower(), [name.lower() for name in restaurant_names], n=5, cutoff=0.8)
+        # If no exact matches, use fuzzy matching on the candidates from the trigram index
+        close_matches = name_index.close_matches(restaurant_name, n=5, cutoff=0.8)
 
         if not close_matches:
             return None
 
         # Find the matching restaurants
-        matches = []
-        for restaurant in all_restaurants:
-            name = restaurant.get('restaurantname', '').strip()
-            if name.lower() in close_matches:
-                matches.append(restaurant)
+        matches = name_index.records_named(close_matches)
 
         if len(matches) == 1:
             restaurant_id = matches[0].get('id')
-            return get_restaurant_details(restaurant_id)
+            return get_restaurant_details(restaurant_id, record=matches[0])
         else:
             # List the matches
             response_text = "I found multiple restaurants matching your query:\n\n"
@@ -128,11 +139,10 @@ def get_restaurant_by_exact_name(restaurant_name):
         if all_restaurants is None:
             return None
 
-        for restaurant in all_restaurants:
-            name = restaurant.get('restaurantname', '').strip()
-            if name == restaurant_name:
-                restaurant_id = restaurant.get('id')
-                return get_restaurant_details(restaurant_id)
+        exact_matches = _restaurants_name_index.exact(restaurant_name)
+        if exact_matches:
+            restaurant_id = exact_matches[0].get('id')
+            return get_restaurant_details(restaurant_id, record=exact_matches[0])
 
         return None
 
@@ -140,35 +150,81 @@ def get_restaurant_by_exact_name(restaurant_name):
         logging.error(f"Error getting restaurant by exact name: {e}")
         return None
 
-def get_restaurant_details(restaurant_id):
-    try:
-        api_url = f"http://api.halaltrip.com/v1/api/restaurant/{restaurant_id}"
-        headers = {
-            'APIKEY': HALALTRIP_API_KEY,
-            'TOKEN': HALALTRIP_TOKEN
-        }
-        response = requests.get(api_url, headers=headers)
-
-        if response.status_code == 200:
-            restaurant = response.json().get('data', {})
-            if not restaurant:
-                return "Sorry, I couldn't find details for that restaurant."
-
-            name = restaurant.get('restaurantname', 'N/A').strip()
-            address = restaurant.get('address', 'N/A').strip()
-            description = restaurant.get('description', 'No description available.').strip()
-
-            # Generate Google Maps link using coordinates if available
-            restaurant_lat = float(restaurant.get('latitude', 0))
-            restaurant_lon = float(restaurant.get('longitude', 0))
-            if restaurant_lat != 0 and restaurant_lon != 0:
-                maps_url = f"https://www.google.com/maps/search/?api=1&query={restaurant_lat},{restaurant_lon}"
-            else:
-                # Use address if coordinates are not available
-                encoded_address = urllib.parse.quote_plus(address)
-                maps_url = f"https://www.google.com/maps/search/?api=1&query={encoded_address}"
+def fetch_restaurant_details(restaurant_id):
+    # Return the detail payload for a restaurant (cached), {} if it does not exist, or None on error
+    restaurant = _restaurant_details_cache.get(str(restaurant_id))
+    if restaurant is not None:
+        logging.info(f"Using cached details for restaurant {restaurant_id}.")
+        return restaurant
+
+    api_url = f"http://api.halaltrip.com/v1/api/restaurant/{restaurant_id}"
+    headers = {
+        'APIKEY': HALALTRIP_API_KEY,
+        'TOKEN': HALALTRIP_TOKEN
+    }
+    response = http_client.get(api_url, headers=headers)
+
+    if response.status_code == 200:
+        restaurant = response.json().get('data', {})
+        if restaurant:
+            _restaurant_details_cache.set(str(restaurant_id), restaurant)
+        return restaurant
+    else:
+        logging.error(f"Error fetching restaurant details: {response.status_code} - {response.text}")
+        return None
 
-            response_text = f"""
+def record_restaurant_detail_request(restaurant_id):
+    global _restaurant_detail_requests
+    with _restaurant_detail_requests_lock:
+        _restaurant_detail_requests[str(restaurant_id)] += 1
+        if len(_restaurant_detail_requests) > RESTAURANT_REQUEST_COUNTS_SIZE:
+            # Keep the busiest half so the counter never grows without bound
+            _restaurant_detail_requests = Counter(dict(_restaurant_detail_requests.most_common(RESTAURANT_REQUEST_COUNTS_SIZE // 2)))
+
+def most_requested_restaurants(count):
+    # The most requested ids, then halve every count so old popularity decays
+    global _restaurant_detail_requests
+    with _restaurant_detail_requests_lock:
+        restaurant_ids = [restaurant_id for restaurant_id, _ in _restaurant_detail_requests.most_common(count)]
+        _restaurant_detail_requests = Counter({
+            restaurant_id: hits // 2 for restaurant_id, hits in _restaurant_detail_requests.items() if hits > 1
+        })
+    return restaurant_ids
+
+def prewarm_restaurant_details(restaurant_ids=None, max_workers=8):
+    # Fetch details for the given ids (default: the most requested ones) concurrently into the cache
+    if restaurant_ids is None:
+        restaurant_ids = most_requested_restaurants(RESTAURANT_PREWARM_COUNT)
+    missing = [restaurant_id for restaurant_id in restaurant_ids if str(restaurant_id) not in _restaurant_details_cache]
+    if not missing:
+        return
+
+    def fetch_quietly(restaurant_id):
+        try:
+            fetch_restaurant_details(restaurant_id)
+        except Exception as e:
+            logging.error(f"Error prewarming details for restaurant {restaurant_id}: {e}")
+
+    logging.info(f"Prewarming details for {len(missing)} restaurants.")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(fetch_quietly, missing))
+
+def format_restaurant_details(restaurant):
+    name = restaurant.get('restaurantname', 'N/A').strip()
+    address = restaurant.get('address', 'N/A').strip()
+    description = restaurant.get('description', 'No description available.').strip()
+
+    # Generate Google Maps link using coordinates if available
+    restaurant_lat = float(restaurant.get('latitude', 0))
+    restaurant_lon = float(restaurant.get('longitude', 0))
+    if restaurant_lat != 0 and restaurant_lon != 0:
+        maps_url = f"https://www.google.com/maps/search/?api=1&query={restaurant_lat},{restaurant_lon}"
+    else:
+        # Use address if coordinates are not available
+        encoded_address = urllib.parse.quote_plus(address)
+        maps_url = f"https://www.google.com/maps/search/?api=1&query={encoded_address}"
+
+    response_text = f"""
 **{name}**
 
 📍 Address: {address}
@@ -179,11 +235,22 @@ def get_restaurant_details(restaurant_id):
 
 *Let me know if you need more information about this restaurant.*
 """
-            return response_text.strip()
+    return response_text.strip()
 
-        else:
-            logging.error(f"Error fetching restaurant details: {response.status_code} - {response.text}")
+def get_restaurant_details(restaurant_id, record=None):
+    try:
+        record_restaurant_detail_request(restaurant_id)
+
+        # The list record already has everything the reply shows
+        if record is not None and all(record.get(field) for field in RESTAURANT_DETAIL_FIELDS):
+            return format_restaurant_details(record)
+
+        restaurant = fetch_restaurant_details(restaurant_id)
+        if restaurant is None:
             return "Sorry, I couldn't retrieve the restaurant details at the moment."
+        if not restaurant:
+            return "Sorry, I couldn't find details for that restaurant."
+        return format_restaurant_details(restaurant)
 
     except Exception as e:
         logging.error(f"Error fetching restaurant details: {e}")
@@ -197,36 +264,10 @@ def get_restaurants(area=None, city=None, country=None, cuisine=None):
         if all_restaurants is None:
             return "Sorry, I couldn't fetch the restaurant data at the moment."
 
-        # Filter the restaurants based on area, city, country, and cuisine
-        matches = []
-
-        area_keywords = []
-        if area:
-            area_lower = area.lower()
-            area_keywords = area_lower.split()
-
-        for restaurant in all_restaurants:
-            address = restaurant.get('address', '').lower()
-            name = restaurant.get('restaurantname', '').lower()
-
-            # Combine address and name for matching
-            combined_text = f"{name} {address}"
-
-            # Check for area match
-            area_match = True
-            if area_keywords:
-                area_match = all(keyword in combined_text for keyword in area_keywords)
-
-            # Filter by cuisine if provided (Note: Cuisine field may not exist)
-            cuisine_match = True
-            if cuisine:
-                # Assuming 'description' field might contain cuisine information
-                description = restaurant.get('description', '').strip().lower()
-                if cuisine.lower() not in description:
-                    cuisine_match = False
-
-            if area_match and cuisine_match:
-                matches.append(restaurant)
+        # Filter the restaurants based on area and cuisine by intersecting posting lists.
+        # Area keywords must all appear in the name or address; cuisine is looked up in
+        # the description (Note: Cuisine field may not exist).
+        matches = _restaurants_text_index.search(area=area, cuisine=cuisine)
 
         # Handle case when no restaurants are found
         if not matches:
@@ -295,28 +336,20 @@ def get_restaurants_nearby(latitude, longitude, radius=5, cuisine=None, dietary_
         if all_restaurants is None:
             return "Sorry, I couldn't fetch the restaurant data at the moment."
 
-        # Filter the restaurants within the specified radius
+        # Filter the restaurants within the specified radius (nearest first) using the spatial index.
+        # Only the top 5 are shown, so let the index select them unless cuisine filtering follows.
         matches = []
+        limit = None if cuisine else 5
 
-        for restaurant in all_restaurants:
-            restaurant_lat = float(restaurant.get('latitude', 0))
-            restaurant_lon = float(restaurant.get('longitude', 0))
-            if restaurant_lat == 0 and restaurant_lon == 0:
-                continue  # Skip if coordinates are not available
-            distance = haversine(longitude, latitude, restaurant_lon, restaurant_lat)
-            if distance <= radius:
-                # Filter by cuisine if provided
-                if cuisine:
-                    # Assuming 'description' field might contain cuisine information
-                    description = restaurant.get('description', '').strip().lower()
-                    if cuisine.lower() not in description:
-                        continue  # Skip if cuisine doesn't match
-                # Filter by dietary preferences if needed (not in data)
-                restaurant['distance'] = distance
-                matches.append(restaurant)
-
-        # Sort the matches by distance
-        matches.sort(key=lambda x: x['distance'])
+        for result in _restaurants_spatial_index.within_radius(latitude, longitude, radius, limit=limit):
+            # Filter by cuisine if provided
+            if cuisine:
+                # Assuming 'description' field might contain cuisine information
+                description = result.record.get('description', '').strip().lower()
+                if cuisine.lower() not in description:
+                    continue  # Skip if cuisine doesn't match
+            # Filter by dietary preferences if needed (not in data)
+            matches.append(result)
 
         if not matches:
             return f"No halal restaurants found within {radius} km of your location."
@@ -327,11 +360,12 @@ def get_restaurants_nearby(latitude, longitude, radius=5, cuisine=None, dietary_
             response_text += f" serving {cuisine} cuisine"
         response_text += ":**\n\n"
 
-        for i, restaurant in enumerate(matches[:5]):  # Show top 5 restaurants
+        for i, result in enumerate(matches[:5]):  # Show top 5 restaurants
+            restaurant = result.record
             name = restaurant.get('restaurantname', 'N/A').strip()
             address = restaurant.get('address', 'N/A').strip()
             description = restaurant.get('description', '').strip()
-            distance = restaurant.get('distance', 0)
+            distance = result.distance
 
             # Generate Google Maps link using coordinates
             restaurant_lat = float(restaurant.get('latitude', 0))
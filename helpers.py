@@ -1,7 +1,7 @@
 # helpers.py
 
 import os
-import requests
+import http_client
 import logging
 import spacy
 from spacy.matcher import Matcher
@@ -9,6 +9,14 @@ from dotenv import load_dotenv
 import docx  # Library to handle .docx files
 import re
 import dateparser
+import json
+import threading
+from cache import PersistentCache
+
+try:
+    from timezonefinder import TimezoneFinder  # Offline time zone boundary polygons
+except ImportError:
+    TimezoneFinder = None
 
 
 # Load environment variables
@@ -20,6 +28,22 @@ GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 # Load the NLP model for English
 nlp = spacy.load("en_core_web_sm")
 
+# Geocoding and time zone lookups, persisted on disk so popular places only hit Google once
+GEOCODE_CACHE_TTL = int(os.getenv('GEOCODE_CACHE_TTL', 30 * 24 * 3600))
+GEOCODE_MISS_TTL = int(os.getenv('GEOCODE_MISS_TTL', 24 * 3600))
+_geocode_cache = PersistentCache('geocode', GEOCODE_CACHE_TTL)
+_timezone_cache = PersistentCache('timezone', GEOCODE_CACHE_TTL)
+
+# Offline coordinate -> time zone resolver, created on first use (None if unavailable)
+_timezone_finder = None
+_timezone_finder_lock = threading.Lock()
+
+# Cache of parsed .docx paragraphs keyed by path, invalidated when the file's mtime changes.
+# Set DOC_TEXT_CACHE_PATH to also persist parsed text across restarts.
+DOC_TEXT_CACHE_PATH = os.getenv('DOC_TEXT_CACHE_PATH')
+_doc_text_cache = None
+_doc_text_cache_lock = threading.Lock()
+
 def extract_date(message):
     import dateparser
     from dateparser.search import search_dates
@@ -63,62 +87,177 @@ def extract_location(message):
 
     return locations
 
-def detect_city_country(locations):
+def normalize_location_query(query):
+    # Cache key for a free-text location: case and extra whitespace do not matter
+    return ' '.join(str(query).lower().split())
+
+def fetch_geocode(query):
+    # Ask Google to geocode a free-text location. Returns a dict with city, country,
+    # lat and lng, an empty dict if Google has no match, or None on a request error.
+    geocode_url = f"https://maps.googleapis.com/maps/api/geocode/json?address={query}&key={GOOGLE_API_KEY}"
+    response = http_client.get(geocode_url)
+    if response.status_code != 200:
+        logging.error(f"Error fetching geocode data for {query}")
+        return None
+    data = response.json()
+    if len(data['results']) == 0:
+        return {}
+
+    result = data['results'][0]
+    city, country = None, None
+    for component in result['address_components']:
+        if "locality" in component["types"]:
+            city = component["long_name"]
+        if "country" in component["types"]:
+            country = component["long_name"]
+
+    if not city and country and country.lower() == query.lower():
+        city = country
+
+    return {
+        'city': city,
+        'country': country,
+        'lat': result['geometry']['location']['lat'],
+        'lng': result['geometry']['location']['lng']
+    }
+
+def geocode(query):
+    # Geocode a location, going to Google only on a cache miss.
+    # Places that Google cannot find are remembered for a shorter time.
+    key = normalize_location_query(query)
+    location = _geocode_cache.get(key)
+    if location is not None:
+        return location or None
+    location = fetch_geocode(query)
+    if location is None:
+        return None
+    _geocode_cache.set(key, location, ttl=None if location else GEOCODE_MISS_TTL)
+    return location or None
+
+def detect_location(locations):
+    # First of the candidate locations that geocodes to a known city and country,
+    # including its coordinates so later steps do not have to geocode it again
     for loc in locations:
-        geocode_url = f"https://maps.googleapis.com/maps/api/geocode/json?address={loc}&key={GOOGLE_API_KEY}"
-        response = requests.get(geocode_url)
-        if response.status_code == 200:
-            data = response.json()
-            if len(data['results']) > 0:
-                address_components = data['results'][0]['address_components']
-                city, country = None, None
-
-                for component in address_components:
-                    if "locality" in component["types"]:
-                        city = component["long_name"]
-                    if "country" in component["types"]:
-                        country = component["long_name"]
-
-                if not city and country and country.lower() == loc.lower():
-                    city = country
-
-                if city and country:
-                    return city, country
-        else:
-            logging.error(f"Error fetching geocode data for {loc}")
+        location = geocode(loc)
+        if location and location['city'] and location['country']:
+            return location
+    return None
+
+def detect_city_country(locations):
+    location = detect_location(locations)
+    if location:
+        return location['city'], location['country']
     return None, None
 
 def get_lat_long(city, country):
-    geocode_url = f"https://maps.googleapis.com/maps/api/geocode/json?address={city},{country}&key={GOOGLE_API_KEY}"
-    response = requests.get(geocode_url)
-    if response.status_code == 200:
-        data = response.json()
-        if len(data['results']) > 0:
-            lat = data['results'][0]['geometry']['location']['lat']
-            lng = data['results'][0]['geometry']['location']['lng']
-            logging.info(f"Latitude: {lat}, Longitude: {lng}")
-            return lat, lng
+    location = geocode(f"{city},{country}")
+    if location:
+        lat, lng = location['lat'], location['lng']
+        logging.info(f"Latitude: {lat}, Longitude: {lng}")
+        return lat, lng
     logging.error(f"Error fetching lat/lng for {city}, {country}")
     return None, None
 
+def get_timezone_finder():
+    global _timezone_finder
+    if TimezoneFinder is None:
+        return None
+    with _timezone_finder_lock:
+        if _timezone_finder is None:
+            _timezone_finder = TimezoneFinder()
+        return _timezone_finder
+
+def get_offline_timezone(lat, lng):
+    # Resolve the time zone from bundled boundary data, without a network call
+    finder = get_timezone_finder()
+    if finder is None:
+        return None
+    try:
+        return finder.timezone_at(lat=float(lat), lng=float(lng))
+    except Exception as e:
+        logging.error(f"Error resolving timezone offline for {lat}, {lng}: {e}")
+        return None
+
 def get_timezone(lat, lng):
+    # Resolve offline when timezonefinder is installed, otherwise ask Google.
+    # Google's answers are cached per coordinate (rounded to about 1 km).
+    timezone = get_offline_timezone(lat, lng)
+    if timezone:
+        return timezone
+
+    key = f"{round(float(lat), 2)},{round(float(lng), 2)}"
+    timezone = _timezone_cache.get(key)
+    if timezone:
+        return timezone
+
     import time
     timestamp = int(time.time())
     timezone_url = f"https://maps.googleapis.com/maps/api/timezone/json?location={lat},{lng}&timestamp={timestamp}&key={GOOGLE_API_KEY}"
-    response = requests.get(timezone_url)
+    response = http_client.get(timezone_url)
     if response.status_code == 200:
         data = response.json()
-        logging.info(f"Timezone ID: {data['timeZoneId']}")
-        return data['timeZoneId']
+        timezone = data.get('timeZoneId')
+        if timezone:
+            logging.info(f"Timezone ID: {timezone}")
+            _timezone_cache.set(key, timezone)
+            return timezone
     logging.error(f"Error fetching timezone for {lat}, {lng}")
     return None
 
-def read_word_doc(filepath):
+def _load_doc_text_cache():
+    global _doc_text_cache
+    if _doc_text_cache is None:
+        _doc_text_cache = {}
+        if DOC_TEXT_CACHE_PATH and os.path.exists(DOC_TEXT_CACHE_PATH):
+            try:
+                with open(DOC_TEXT_CACHE_PATH, 'r') as f:
+                    _doc_text_cache = json.load(f)
+            except Exception as e:
+                logging.error(f"Error loading document text cache: {e}")
+    return _doc_text_cache
+
+def _save_doc_text_cache():
+    if not DOC_TEXT_CACHE_PATH:
+        return
+    try:
+        os.makedirs(os.path.dirname(DOC_TEXT_CACHE_PATH) or '.', exist_ok=True)
+        with open(DOC_TEXT_CACHE_PATH, 'w') as f:
+            json.dump(_doc_text_cache, f)
+    except Exception as e:
+        logging.error(f"Error saving document text cache: {e}")
+
+def invalidate_doc_text_cache(filepath=None):
+    # Drop one document (or all of them) from the parsed text cache
+    global _doc_text_cache
+    with _doc_text_cache_lock:
+        if filepath is None:
+            _doc_text_cache = {}
+        else:
+            _load_doc_text_cache().pop(filepath, None)
+        _save_doc_text_cache()
+
+def read_word_doc_paragraphs(filepath):
+    # Return (style_name, text) pairs for every non-empty paragraph, keeping heading styles.
+    # Each document is parsed once per modification.
+    mtime = os.path.getmtime(filepath)
+    with _doc_text_cache_lock:
+        cached = _load_doc_text_cache().get(filepath)
+        if cached and cached['mtime'] == mtime:
+            return [tuple(paragraph) for paragraph in cached['paragraphs']]
+
     doc = docx.Document(filepath)
-    full_text = []
+    paragraphs = []
     for paragraph in doc.paragraphs:
-        full_text.append(paragraph.text)
-    return "\n".join(full_text)
+        text = paragraph.text.strip()
+        if text:
+            style_name = paragraph.style.name if paragraph.style is not None else ''
+            paragraphs.append((style_name, text))
+    logging.info(f"Parsed document {filepath}")
+
+    with _doc_text_cache_lock:
+        _load_doc_text_cache()[filepath] = {'mtime': mtime, 'paragraphs': paragraphs}
+        _save_doc_text_cache()
+    return paragraphs
 
 def extract_flight_details(message):
     try:
@@ -0,0 +1,79 @@
+# http_client.py
+
+import os
+import logging
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connection pool, timeout and retry settings shared by every HalalTrip and Google API call
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 32))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 3))
+HTTP_BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', 0.5))
+
+# Number of pages requested at once when crawling a paginated endpoint
+PAGE_FETCH_CONCURRENCY = int(os.getenv('PAGE_FETCH_CONCURRENCY', 8))
+
+def create_session():
+    # Keep-alive session with a connection pool per host and retry/backoff on transient errors
+    retry = Retry(
+        total=HTTP_MAX_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False  # Return the last response so callers can check status_code
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+session = create_session()
+
+def get(url, params=None, headers=None, timeout=None):
+    # Drop-in replacement for requests.get that reuses pooled connections
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    return session.get(url, params=params, headers=headers, timeout=timeout)
+
+class PaginationError(requests.exceptions.HTTPError):
+    # Raised when a page of a paginated crawl returns a non-200 response
+    def __init__(self, page, response):
+        super().__init__(f"Error fetching page {page}: {response.status_code} - {response.text}", response=response)
+        self.page = page
+
+_page_executor = ThreadPoolExecutor(max_workers=PAGE_FETCH_CONCURRENCY, thread_name_prefix='pages')
+
+def fetch_page(url, page, headers=None):
+    response = get(url, params={'page': page}, headers=headers)
+    if response.status_code != 200:
+        raise PaginationError(page, response)
+    return response.json().get('data', [])
+
+def fetch_all_pages(url, headers=None, label='items', concurrency=PAGE_FETCH_CONCURRENCY):
+    # Fetch every page of a HalalTrip list endpoint. Pages are requested in windows of
+    # `concurrency` at a time but consumed in page order, so the result (and which error
+    # is raised) is the same as a sequential crawl: it stops at the first empty page, and
+    # a failed page before that aborts the crawl with PaginationError.
+    all_items = []
+    page = 1
+    while True:
+        pages = list(range(page, page + concurrency))
+        futures = [_page_executor.submit(fetch_page, url, p, headers) for p in pages]
+        try:
+            for p, future in zip(pages, futures):
+                items = future.result()
+                if not items:
+                    logging.info(f"No more {label} found at page {p}. Ending pagination.")
+                    return all_items
+                logging.info(f"Fetched {len(items)} {label} from page {p}.")
+                all_items.extend(items)
+        finally:
+            # Drop any requests that have not started once the outcome is known
+            for future in futures:
+                future.cancel()
+        page += concurrency
@@ -0,0 +1,163 @@
+# intent_classifier.py
+
+import os
+import re
+import logging
+import numpy as np
+from collections import defaultdict
+from text_index import tokenize
+from cache import PersistentCache
+
+# Labelled examples. These are also the few-shot examples of the GPT classification prompt,
+# so keep them in the order they should appear there.
+INTENT_EXAMPLES = [
+    ("Hi", "greeting"),
+    ("Hello there", "greeting"),
+    ("List 5 mosques in Bedok Singapore", "mosque_query"),
+    ("Mosques near me", "mosque_near_me"),
+    ("Show me halal restaurants in Kuala Lumpur", "restaurant_query"),
+    ("What are the prayer times in Dubai", "prayer_time_query"),
+    ("Tell me more about Muslim Restaurant in Bangkok", "restaurant_detail_query"),
+    ("Where is the nearest halal restaurant?", "restaurant_near_me"),
+    ("Find mosques nearby", "mosque_near_me"),
+    ("What is the Qibla direction?", "qibla_direction"),
+    ("Are there any halal Thai restaurants in Bangkok?", "restaurant_cuisine_query"),
+    ("Does Muslim Restaurant offer delivery services?", "restaurant_service_query"),
+    ("What are the opening hours of Muslim Restaurant in Bangkok?", "restaurant_operating_hours_query"),
+    ("I'm looking for a halal restaurant in Bangkok to celebrate a special occasion.", "restaurant_special_request"),
+    ("Can you provide inflight prayer times from SIN to DEL on 28-02-2019?", "inflight_prayer_times"),
+    ("I need inflight prayer times for my flight from JFK to LHR.", "inflight_prayer_times"),
+    ("Can you show me travel packages to Bosnia?", "package_query"),
+    ("Tell me more about package ID 420", "package_query"),
+    ("I'd like to know about the Bosnian Odyssey package.", "package_query"),
+    ("Can you recommend travel packages to Turkey for 7 days?", "package_query"),
+    ("Suggest me a 5-day trip travel package to Europe for my honeymoon.", "package_query"),
+    ("Does the time for Zuhr change during Ramadan in Jakarta?.", "general_question"),
+    ("does prayer time changes during ramadan?.", "general_question"),
+]
+
+# Extra examples for the local classifier only (mostly from the welcome message), so the
+# GPT prompt stays exactly as it was
+LOCAL_INTENT_EXAMPLES = [
+    ("Halal restaurants near me", "restaurant_near_me"),
+    ("Where is the nearest mosque?", "mosque_near_me"),
+    ("List mosques near me.", "mosque_near_me"),
+    ("Mosques in Singapore", "mosque_query"),
+    ("When is Maghrib prayer in London?", "prayer_time_query"),
+    ("Prayer times in Jakarta today.", "prayer_time_query"),
+    ("What is the Qibla direction from my location?", "qibla_direction"),
+    ("Assalamu Alaikum", "greeting"),
+    ("Hello", "greeting"),
+    ("Prayer times", "prayer_time_query"),
+    ("Halal restaurants", "restaurant_query"),
+    ("Travel packages", "package_query"),
+    # Questions about a topic rather than requests for data; these belong to general_question
+    ("Why are prayer times different in each city?", "general_question"),
+    ("How are prayer times calculated?", "general_question"),
+    ("Are these prayer times accurate?", "general_question"),
+    ("What is Qiyam", "general_question"),
+    ("What should I know about fasting while travelling?", "general_question"),
+]
+
+# A local prediction is used only if its best example similarity reaches the threshold
+# and beats the best example of any other intent by the margin; otherwise we ask GPT
+INTENT_CONFIDENCE_THRESHOLD = float(os.getenv('INTENT_CONFIDENCE_THRESHOLD', 0.7))
+INTENT_CONFIDENCE_MARGIN = float(os.getenv('INTENT_CONFIDENCE_MARGIN', 0.2))
+
+# Explanatory questions ("why are prayer times...", "are the prayer times accurate?") share
+# words with data requests but are general questions, so they always go to GPT
+EXPLANATORY_QUESTION = re.compile(
+    r"\b(?:why|how|explain|reason|based on|accurate|accuracy|correct|reliable|calculated?|calculation"
+    r"|differ|different|difference|change|changes|changed|mean|meaning)\b"
+)
+
+# Follow-ups to these intents depend on the conversation (e.g. a bare package ID or
+# restaurant name), which the local classifier cannot see
+CONTEXT_DEPENDENT_INTENTS = {'package_query', 'restaurant_detail_query'}
+
+# GPT classifications of normalized messages, persisted with LRU eviction. The raw intent
+# is cached; the previous_intent adjustments are applied on top by the caller.
+INTENT_CACHE_SIZE = int(os.getenv('INTENT_CACHE_SIZE', 10000))
+INTENT_CACHE_TTL = int(os.getenv('INTENT_CACHE_TTL', 30 * 24 * 3600))
+_intent_cache = PersistentCache('intents', INTENT_CACHE_TTL, maxsize=INTENT_CACHE_SIZE)
+
+_classifier = None
+
+def features(text):
+    # Word unigrams and bigrams
+    tokens = tokenize(text)
+    return tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+class IntentClassifier:
+    # TF-IDF nearest-neighbour classifier: a message gets the intent of the labelled
+    # example it is most similar to (cosine similarity of TF-IDF vectors).
+    def __init__(self, examples):
+        self.labels = [intent for _, intent in examples]
+        documents = [features(message) for message, _ in examples]
+
+        self.vocabulary = {}
+        document_frequency = defaultdict(int)
+        for document in documents:
+            for term in set(document):
+                self.vocabulary.setdefault(term, len(self.vocabulary))
+                document_frequency[term] += 1
+        self.idf = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for term, idx in self.vocabulary.items():
+            self.idf[idx] = np.log((1 + len(documents)) / (1 + document_frequency[term])) + 1
+
+        self.matrix = np.vstack([self.vectorize_features(document) for document in documents])
+
+    def vectorize_features(self, terms):
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for term in terms:
+            idx = self.vocabulary.get(term)
+            if idx is not None:
+                vector[idx] += 1
+        vector = np.log1p(vector) * self.idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def predict(self, text):
+        # Return (intent, score, runner_up_score) for the most similar example
+        scores = self.matrix @ self.vectorize_features(features(text))
+        best_by_intent = {}
+        for label, score in zip(self.labels, scores):
+            if score > best_by_intent.get(label, -1):
+                best_by_intent[label] = float(score)
+        ranked = sorted(best_by_intent.items(), key=lambda item: item[1], reverse=True)
+        intent, score = ranked[0]
+        runner_up_score = ranked[1][1] if len(ranked) > 1 else 0.0
+        return intent, score, runner_up_score
+
+def get_classifier():
+    global _classifier
+    if _classifier is None:
+        _classifier = IntentClassifier(INTENT_EXAMPLES + LOCAL_INTENT_EXAMPLES)
+    return _classifier
+
+def classify_intent_locally(user_message, previous_intent=None):
+    # Intent for confidently classified messages, or None to fall back to GPT
+    if previous_intent in CONTEXT_DEPENDENT_INTENTS:
+        return None
+    if EXPLANATORY_QUESTION.search(normalize_message(user_message)):
+        logging.info("Explanatory question, leaving it to GPT")
+        return None
+    intent, score, runner_up_score = get_classifier().predict(user_message)
+    if score < INTENT_CONFIDENCE_THRESHOLD or score - runner_up_score < INTENT_CONFIDENCE_MARGIN:
+        logging.info(f"Local intent classifier not confident ({intent}: {score:.2f}, runner-up {runner_up_score:.2f})")
+        return None
+    logging.info(f"Local intent classifier: {intent} ({score:.2f})")
+    return intent
+
+def normalize_message(user_message):
+    # Case, punctuation and spacing do not change the intent
+    return ' '.join(tokenize(user_message))
+
+def get_cached_intent(user_message):
+    key = normalize_message(user_message)
+    return _intent_cache.get(key) if key else None
+
+def cache_intent(user_message, intent):
+    key = normalize_message(user_message)
+    if key and intent:
+        _intent_cache.set(key, intent)
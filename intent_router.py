@@ -0,0 +1,61 @@
+# intent_router.py
+
+import re
+import logging
+from collections import Counter
+from helpers import extract_flight_details
+from intent_classifier import normalize_message
+
+# Messages that can only mean one thing, matched against the normalized message
+# (lowercase words separated by single spaces)
+GREETINGS = {
+    "hi", "hii", "hello", "hey", "hi there", "hello there", "hey there",
+    "salam", "assalamualaikum", "assalamu alaikum", "assalamu alaykum", "as salamu alaykum",
+    "good morning", "good afternoon", "good evening"
+}
+
+NEAR_ME = r"(?:near me|nearby|near my location|around me|around here|close to me)"
+
+INTENT_RULES = [
+    ('qibla_direction', re.compile(
+        r"^(?:(?:what|where) is |show me |find |get )?(?:the )?qibla(?: direction)?(?: from (?:my location|here))?$"
+    )),
+    ('mosque_near_me', re.compile(
+        rf"^(?:(?:find|show|list|show me|where are|are there any|any) )?(?:the )?(?:mosques?|masjids?) {NEAR_ME}$"
+        r"|^where is the nearest (?:mosque|masjid)$"
+    )),
+    ('restaurant_near_me', re.compile(
+        rf"^(?:(?:find|show|list|show me|where are|are there any|any) )?(?:the )?halal (?:restaurants?|food) {NEAR_ME}$"
+        r"|^where is the nearest halal (?:restaurant|food)$"
+    )),
+]
+
+# Two IATA codes, checked before the full extract_flight_details parse
+IATA_PAIR = re.compile(r'\b[A-Z]{3}\b.*\b[A-Z]{3}\b', re.DOTALL)
+
+# How often each route resolved an intent: rule:<intent>, local, cache and gpt
+intent_route_counts = Counter()
+
+def route_intent(user_message):
+    # Intent for messages that match a deterministic rule, or None to classify them
+    normalized = normalize_message(user_message)
+    if normalized in GREETINGS:
+        return 'greeting'
+    for intent, pattern in INTENT_RULES:
+        if pattern.match(normalized):
+            return intent
+    # Airport codes plus departure (and arrival) times are only ever an inflight prayer times request
+    if 'departing' in user_message.lower() and IATA_PAIR.search(user_message) and extract_flight_details(user_message):
+        return 'inflight_prayer_times'
+    return None
+
+def intent_stats():
+    total = sum(intent_route_counts.values())
+    return {
+        'total': total,
+        'routes': dict(intent_route_counts.most_common())
+    }
+
+def record_intent_route(route, intent):
+    intent_route_counts[route] += 1
+    logging.info(f"Intent {intent} resolved by {route}")
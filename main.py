@@ -4,9 +4,12 @@ import os
 import logging
 import re
 import difflib
-from fastapi import FastAPI
+import asyncio
+import json
+import hmac
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import openai
@@ -25,6 +28,7 @@ from get_inflight_prayer_times import get_inflight_prayer_times
 from helpers import (
     extract_location,
     detect_city_country,
+    detect_location,
     extract_flight_details,
     extract_restaurant_name,
     extract_keyword,
@@ -32,10 +36,21 @@ from helpers import (
     extract_package_name,
     extract_duration,
     extract_special_request,
-    extract_date
+    extract_date,
+    invalidate_doc_text_cache
 )
-from embeddings import search_all_docs
-from get_packages import get_all_packages, get_package_by_id
+from embeddings import search_all_docs, build_index
+from intent_classifier import INTENT_EXAMPLES, classify_intent_locally, get_cached_intent, cache_intent
+from intent_router import route_intent, record_intent_route, intent_stats
+from moderation import is_flagged
+from get_packages import (
+    get_all_packages,
+    get_package_by_id,
+    start_package_refresh,
+    prefetch_packages_in_background
+)
+from cache import TTLCache
+from concurrency import run_blocking
 
 # Import LangChain components
 from langchain.memory import ConversationBufferMemory
@@ -71,6 +86,34 @@ async def serve_html():
 # Set OpenAI API key
 openai.api_key = os.getenv('OPENAI_API_KEY')
 
+# Build the document embedding index once at startup instead of per request
+@app.on_event("startup")
+async def load_document_index():
+    # A failure only affects document answers, so the app still starts; the index is
+    # built again on the first /chat_with_file request
+    try:
+        await run_blocking(build_index)
+    except Exception as e:
+        logging.error(f"Error building document index at startup: {e}")
+
+# Warm the package catalog and keep refreshing it in the background
+@app.on_event("startup")
+async def warm_package_catalog():
+    start_package_refresh()
+
+# Re-parse the documents and refresh the embedding index after files in static/files change.
+# Only available when ADMIN_TOKEN is set, to callers that send it in the X-Admin-Token header.
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+@app.post("/reload_docs")
+async def reload_docs(x_admin_token: str = Header(None)):
+    if not ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    invalidate_doc_text_cache()
+    doc_embeddings, doc_chunks = await run_blocking(build_index)
+    documents = {chunk['filename'] for chunk in doc_chunks}
+    return {"documents": len(documents), "chunks": len(doc_chunks)}
+
 # Global dictionary to hold conversation states
 conversation_states = {}
 
@@ -81,103 +124,172 @@ class ChatMessageRequest(BaseModel):
     # Latitude and longitude are optional and used for 'near me' features
     latitude: float = None
     longitude: float = None
+    # Optional client-generated id that makes retries of the same message idempotent
+    messageId: str = None
+
+# Short-lived cache of replies keyed by (endpoint, threadId, messageId), and the
+# requests currently being processed so duplicates wait for the first one
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 300))
+response_cache = TTLCache(maxsize=2048, ttl=RESPONSE_CACHE_TTL)
+inflight_requests = {}
+
+async def handle_idempotent(endpoint, request, handler):
+    # Run handler once per client message id; repeats get the same reply without reprocessing
+    if not request.messageId:
+        return await handler(request)
+
+    key = (endpoint, request.threadId, request.messageId)
+    cached_reply = response_cache.get(key)
+    if cached_reply is not None:
+        logging.info(f"Returning cached reply for message {request.messageId}")
+        return cached_reply
+
+    if key in inflight_requests:
+        logging.info(f"Waiting for in-flight reply for message {request.messageId}")
+        return await asyncio.shield(inflight_requests[key])
+
+    future = asyncio.get_running_loop().create_future()
+    inflight_requests[key] = future
+    try:
+        reply = await handler(request)
+        response_cache.set(key, reply)
+        future.set_result(reply)
+        return reply
+    except Exception as e:
+        future.set_exception(e)
+        # Mark the exception as retrieved in case no duplicate was waiting on it
+        future.exception()
+        raise
+    finally:
+        inflight_requests.pop(key, None)
+
+async def stream_idempotent(endpoint, request, handler):
+    # Streaming counterpart of handle_idempotent: the finished reply is cached under the same key,
+    # and duplicates that arrive while it streams wait for it instead of reprocessing the message
+    if not request.messageId:
+        result = await handler(request, stream=True)
+        return StreamingResponse(ndjson_stream(result, lambda full_reply: None), media_type="application/x-ndjson")
+
+    key = (endpoint, request.threadId, request.messageId)
+    cached_reply = response_cache.get(key)
+    if cached_reply is None and key in inflight_requests:
+        logging.info(f"Waiting for in-flight reply for message {request.messageId}")
+        cached_reply = await asyncio.shield(inflight_requests[key])
+    if cached_reply is not None:
+        return StreamingResponse(ndjson_stream(cached_reply, lambda full_reply: None), media_type="application/x-ndjson")
+
+    future = asyncio.get_running_loop().create_future()
+    # Mark a failure as retrieved in case no duplicate was waiting on it
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    inflight_requests[key] = future
+
+    def release():
+        if not future.done():
+            future.set_exception(RuntimeError(f"Reply for message {request.messageId} did not complete"))
+        if inflight_requests.get(key) is future:
+            inflight_requests.pop(key)
 
-# Function to check if input is acceptable using OpenAI's Moderation API
-def is_input_acceptable(user_input):
-    response = openai.Moderation.create(input=user_input)
-    flagged = response['results'][0]['flagged']
-    return not flagged  # Returns True if input is acceptable
-
-# Intent classification function using GPT-4
-def classify_intent_with_gpt(user_message, previous_intent=None):
-    prompt = f"""
-You are an AI assistant that classifies user messages into specific intents. Here are some examples:
-
-User Message: "Hi"
-Intent: greeting
-
-User Message: "Hello there"
-Intent: greeting
-
-User Message: "List 5 mosques in Bedok Singapore"
-Intent: mosque_query
-
-User Message: "Mosques near me"
-Intent: mosque_near_me
-
-User Message: "Show me halal restaurants in Kuala Lumpur"
-Intent: restaurant_query
-
-User Message: "What are the prayer times in Dubai"
-Intent: prayer_time_query
-
-User Message: "Tell me more about Muslim Restaurant in Bangkok"
-Intent: restaurant_detail_query
-
-User Message: "Where is the nearest halal restaurant?"
-Intent: restaurant_near_me
-
-User Message: "Find mosques nearby"
-Intent: mosque_near_me
-
-User Message: "What is the Qibla direction?"
-Intent: qibla_direction
-
-User Message: "Are there any halal Thai restaurants in Bangkok?"
-Intent: restaurant_cuisine_query
-
-User Message: "Does Muslim Restaurant offer delivery services?"
-Intent: restaurant_service_query
-
-User Message: "What are the opening hours of Muslim Restaurant in Bangkok?"
-Intent: restaurant_operating_hours_query
-
-User Message: "I'm looking for a halal restaurant in Bangkok to celebrate a special occasion."
-Intent: restaurant_special_request
-
-User Message: "Can you provide inflight prayer times from SIN to DEL on 28-02-2019?"
-Intent: inflight_prayer_times
-
-User Message: "I need inflight prayer times for my flight from JFK to LHR."
-Intent: inflight_prayer_times
-
-User Message: "Can you show me travel packages to Bosnia?"
-Intent: package_query
+    try:
+        result = await handler(request, stream=True)
+    except BaseException:
+        release()
+        raise
+
+    def remember_reply(full_reply):
+        reply = {"bot_reply": full_reply, "threadId": result['threadId']}
+        response_cache.set(key, reply)
+        if not future.done():
+            future.set_result(reply)
+
+    async def events():
+        try:
+            async for event in ndjson_stream(result, remember_reply):
+                yield event
+        finally:
+            release()
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+async def ndjson_stream(result, on_complete):
+    # Emit the reply as newline-delimited JSON events: {"delta": ...} for each piece of text,
+    # then {"done": true, "threadId": ...}. Plain string replies are sent as a single delta.
+    reply = result['bot_reply']
+    if isinstance(reply, str):
+        yield json.dumps({"delta": reply}) + "\n"
+        full_reply = reply
+    else:
+        parts = []
+        try:
+            async for delta in reply:
+                parts.append(delta)
+                yield json.dumps({"delta": delta}) + "\n"
+        except Exception as e:
+            logging.error(f"Error streaming response: {e}")
+            yield json.dumps({"error": "I'm sorry, I couldn't process your request at the moment."}) + "\n"
+            return
+        full_reply = "".join(parts)
+    on_complete(full_reply)
+    yield json.dumps({"done": True, "threadId": result['threadId']}) + "\n"
+
+async def with_completion(deltas, on_complete):
+    # Pass text deltas through and call on_complete with the full text once the stream ends
+    parts = []
+    async for delta in deltas:
+        parts.append(delta)
+        yield delta
+    on_complete("".join(parts))
+
+def completion_reply(response, stream=False, on_complete=None):
+    # Return the completion text, or a generator of text deltas when streaming.
+    # on_complete (if given) is called with the full text once it is known.
+    if not stream:
+        bot_reply = response['choices'][0]['message']['content']
+        if on_complete:
+            on_complete(bot_reply)
+        return bot_reply
 
-User Message: "Tell me more about package ID 420"
-Intent: package_query
+    async def deltas():
+        async for chunk in response:
+            delta = chunk['choices'][0].get('delta', {}).get('content')
+            if delta:
+                yield delta
 
-User Message: "I'd like to know about the Bosnian Odyssey package."
-Intent: package_query
+    return with_completion(deltas(), on_complete or (lambda full_reply: None))
 
-User Message: "Can you recommend travel packages to Turkey for 7 days?"
-Intent: package_query
+# Function to check if input is acceptable using OpenAI's Moderation API (cached and batched)
+async def is_input_acceptable(user_input):
+    flagged = await is_flagged(user_input)
+    return not flagged  # Returns True if input is acceptable
 
-User Message: "Suggest me a 5-day trip travel package to Europe for my honeymoon."
-Intent: package_query
+# Few-shot prompt for GPT intent classification, built from the labelled examples
+INTENT_PROMPT_EXAMPLES = "\n\n".join(
+    f'User Message: "{example}"\nIntent: {intent}' for example, intent in INTENT_EXAMPLES
+)
 
-User Message: "Does the time for Zuhr change during Ramadan in Jakarta?."
-Intent: general_question
+# Intent classification function using GPT-4
+async def classify_intent_with_gpt(user_message):
+    prompt = f"""
+You are an AI assistant that classifies user messages into specific intents. Here are some examples:
 
-User Message: "does prayer time changes during ramadan?."
-Intent: general_question
+{INTENT_PROMPT_EXAMPLES}
 
 
 User Message: "{user_message}"
 Intent:"""
 
-    response = openai.ChatCompletion.create(
+    response = await openai.ChatCompletion.acreate(
         model="gpt-4o",
         messages=[
             {"role": "user", "content": prompt}
         ],
-        max_tokens=8000,
+        max_tokens=20,  # The answer is a single intent label
         n=1,
         stop=["\n"],
         temperature=0
     )
-    intent = response.choices[0].message['content'].strip().lower()
+    return response.choices[0].message['content'].strip().lower()
 
+def adjust_intent(intent, previous_intent=None):
     # If previous intent was expecting a package detail
     if previous_intent == 'package_query' and intent == 'package_detail_query':
         return 'package_detail_query'
@@ -188,6 +300,25 @@ Intent:"""
 
     return intent
 
+# Resolve the intent with the cheapest route that is sure of it: deterministic rules,
+# then the local classifier, then a cached GPT answer, and only then GPT itself
+async def classify_intent(user_message, previous_intent=None):
+    intent = route_intent(user_message)
+    if intent:
+        route = f"rule:{intent}"
+    else:
+        intent = classify_intent_locally(user_message, previous_intent=previous_intent)
+        route = 'local'
+    if intent is None:
+        intent = await run_blocking(get_cached_intent, user_message)
+        route = 'cache'
+    if not intent:
+        intent = await classify_intent_with_gpt(user_message)
+        route = 'gpt'
+        await run_blocking(cache_intent, user_message, intent)
+    record_intent_route(route, intent)
+    return adjust_intent(intent, previous_intent)
+
 # Welcome endpoint
 @app.get("/welcome")
 async def welcome():
@@ -235,28 +366,64 @@ Feel free to ask me anything related to your Muslim-friendly travel needs. How m
 """
     return {"bot_reply": welcome_message}
 
+# How many messages each intent route (rules, local classifier, cache, GPT) resolved
+@app.get("/intent_stats")
+async def get_intent_stats():
+    return intent_stats()
+
 # Default chat endpoint
 @app.post("/chat")
 async def chat(request: ChatMessageRequest):
+    return await handle_idempotent("chat", request, process_chat)
+
+# Streaming chat endpoint (NDJSON)
+@app.post("/chat/stream")
+async def chat_stream(request: ChatMessageRequest):
+    return await stream_idempotent("chat", request, process_chat)
+
+# Get or initialize the conversation state for a threadId
+def get_conversation_state(thread_id):
+    if thread_id not in conversation_states:
+        conversation_states[thread_id] = {'last_intent': None, 'data': {}, 'memory': ConversationBufferMemory()}
+    return conversation_states[thread_id]
+
+def cancel_pending(*tasks):
+    # Cancel tasks whose result is no longer needed. Errors of tasks that already
+    # finished are retrieved so asyncio does not report them as unhandled.
+    for task in tasks:
+        if task.done():
+            if not task.cancelled():
+                task.exception()
+        else:
+            task.cancel()
+
+def flagged_reply(request):
+    logging.info("User input was flagged by Moderation API.")
+    return {"bot_reply": "I'm sorry, but I can't assist with that request.", "threadId": request.threadId}
+
+# moderated and intent let /chat_with_file hand over a message it already moderated
+# and classified, so neither is done twice
+async def process_chat(request, stream=False, moderated=False, intent=None):
     logging.info(f"Received message: {request.message} with threadId: {request.threadId}")
     message = request.message.strip()
 
-    # Check if the input is acceptable
-    if not is_input_acceptable(message):
-        bot_reply = "I'm sorry, but I can't assist with that request."
-        logging.info("User input was flagged by Moderation API.")
-        return {"bot_reply": bot_reply, "threadId": request.threadId}
-
-    # Get or initialize the conversation state for this threadId
-    if request.threadId not in conversation_states:
-        conversation_states[request.threadId] = {'last_intent': None, 'data': {}, 'memory': ConversationBufferMemory()}
-    state = conversation_states[request.threadId]
+    state = get_conversation_state(request.threadId)
 
     # Get the previous intent from the conversation state
     previous_intent = state['last_intent']
 
-    # Classify the intent using GPT-4
-    intent = classify_intent_with_gpt(message, previous_intent=previous_intent)
+    if intent is None:
+        # Classify the intent (locally if possible, otherwise with GPT-4) while moderation runs
+        classification = asyncio.create_task(classify_intent(message, previous_intent=previous_intent))
+        try:
+            # Check if the input is acceptable
+            if not moderated and not await is_input_acceptable(message):
+                return flagged_reply(request)
+            intent = await classification
+        finally:
+            cancel_pending(classification)
+    elif not moderated and not await is_input_acceptable(message):
+        return flagged_reply(request)
     logging.info(f"Classified intent: {intent}")
 
     bot_reply = "I'm sorry, I didn't quite understand that. Could you please rephrase your request?"
@@ -268,7 +435,7 @@ async def chat(request: ChatMessageRequest):
 
         elif intent == 'package_query':
             # Handle general package queries without pre-filtering
-            packages = get_all_packages()
+            packages = await run_blocking(get_all_packages)
             if packages:
                 # Prepare the data to include in the prompt
                 package_data = ""
@@ -306,7 +473,7 @@ Provide a brief summary of each recommended package, including its name, ID, dur
                 logging.info(f"Prompt sent to GPT-4: {prompt}")
 
                 # Use OpenAI to generate the bot's reply
-                response = openai.ChatCompletion.create(
+                response = await openai.ChatCompletion.acreate(
                     model="gpt-4o",
                     messages=[
                         {
@@ -319,13 +486,19 @@ Provide a brief summary of each recommended package, including its name, ID, dur
                         }
                     ],
                     max_tokens=8000,  # Adjusted for response length
-                    temperature=0.7
+                    temperature=0.7,
+                    stream=stream
                 )
-                bot_reply = response['choices'][0]['message']['content']
-                # Store the list of package IDs in the conversation state
-                # Extract package IDs from the response (assuming IDs are mentioned)
-                package_ids = re.findall(r'ID[:]? (\d+)', bot_reply)
-                state['data']['expected_packages'] = package_ids
+
+                def remember_packages(full_reply):
+                    # Store the list of package IDs in the conversation state
+                    # Extract package IDs from the response (assuming IDs are mentioned)
+                    package_ids = re.findall(r'ID[:]? (\d+)', full_reply)
+                    state['data']['expected_packages'] = package_ids
+                    # Load the recommended packages now so a follow-up question is answered from memory
+                    prefetch_packages_in_background(package_ids)
+
+                bot_reply = completion_reply(response, stream, remember_packages)
             else:
                 bot_reply = "Sorry, I couldn't find any travel packages at the moment."
             state['last_intent'] = intent
@@ -334,7 +507,7 @@ Provide a brief summary of each recommended package, including its name, ID, dur
             # Handle package detail queries
             package_id = extract_package_id(message)
             if package_id:
-                package = get_package_by_id(package_id)
+                package = await run_blocking(get_package_by_id, package_id)
                 if package:
                     name = package.get('name', 'N/A')
                     description = package.get('description', 'No description available.')
@@ -354,27 +527,30 @@ Provide a brief summary of each recommended package, including its name, ID, dur
                 # If package ID is not provided, check if user selected from previous list
                 if 'expected_packages' in state['data'] and state['data']['expected_packages']:
                     selected_package_name = extract_package_name(message).lower()
+                    # Look up all expected packages concurrently, once per request
+                    expected_packages = state['data']['expected_packages']
+                    fetched_packages = await asyncio.gather(
+                        *(run_blocking(get_package_by_id, pkg_id) for pkg_id in expected_packages)
+                    )
                     # Try to match the selected package name with the expected packages
-                    matching_package_id = None
-                    for pkg_id in state['data']['expected_packages']:
-                        pkg = get_package_by_id(pkg_id)
+                    package = None
+                    for pkg in fetched_packages:
                         if pkg:
                             package_name = pkg.get('name', '').lower()
                             # Use fuzzy matching
                             if selected_package_name == package_name:
-                                matching_package_id = pkg_id
+                                package = pkg
                                 break
                             elif selected_package_name in package_name or package_name in selected_package_name:
-                                matching_package_id = pkg_id
+                                package = pkg
                                 break
                             else:
                                 # Use difflib for approximate matching
                                 ratio = difflib.SequenceMatcher(None, selected_package_name, package_name).ratio()
                                 if ratio > 0.7:
-                                    matching_package_id = pkg_id
+                                    package = pkg
                                     break
-                    if matching_package_id:
-                        package = get_package_by_id(matching_package_id)
+                    if package:
                         name = package.get('name', 'N/A')
                         description = package.get('description', 'No description available.')
                         # Clean the description to remove HTML tags if any
@@ -397,7 +573,7 @@ Provide a brief summary of each recommended package, including its name, ID, dur
             # Handle restaurant detail queries
             restaurant_name = extract_restaurant_name(message)
             if restaurant_name:
-                restaurant_info = get_restaurant_by_name(restaurant_name)
+                restaurant_info = await run_blocking(get_restaurant_by_name, restaurant_name)
                 if restaurant_info:
                     bot_reply = restaurant_info
                     # Clear any previous expected restaurants
@@ -420,7 +596,7 @@ Provide a brief summary of each recommended package, including its name, ID, dur
             expected_restaurants = state['data']['expected_restaurants']
             if restaurant_name in expected_restaurants:
                 # Get the restaurant details
-                restaurant_info = get_restaurant_by_exact_name(restaurant_name)
+                restaurant_info = await run_blocking(get_restaurant_by_exact_name, restaurant_name)
                 if restaurant_info:
                     bot_reply = restaurant_info
                     # Clear the expected restaurants list
@@ -448,7 +624,7 @@ Provide a brief summary of each recommended package, including its name, ID, dur
 
                 radius = 5  # Default radius in kilometers
 
-                mosques_info = get_mosques(latitude=latitude, longitude=longitude, radius=radius)
+                mosques_info = await run_blocking(get_mosques, latitude=latitude, longitude=longitude, radius=radius)
                 bot_reply = mosques_info
             else:
                 bot_reply = "Please enable location services or provide your latitude and longitude to find mosques near you."
@@ -474,7 +650,7 @@ Provide a brief summary of each recommended package, including its name, ID, dur
                         cuisine = keyword
                         break
 
-                restaurants_info = get_restaurants_nearby(latitude=latitude, longitude=longitude, radius=radius, cuisine=cuisine)
+                restaurants_info = await run_blocking(get_restaurants_nearby, latitude=latitude, longitude=longitude, radius=radius, cuisine=cuisine)
                 bot_reply = restaurants_info
             else:
                 bot_reply = "Please enable location services or provide your latitude and longitude to find halal restaurants near you."
@@ -483,7 +659,7 @@ Provide a brief summary of each recommended package, including its name, ID, dur
 
         elif intent == 'restaurant_query':
             # Handle general restaurant queries
-            locations = extract_location(message)
+            locations = await run_blocking(extract_location, message)
             logging.info(f"Extracted locations: {locations}")
 
             # Extract cuisine from the message
@@ -500,13 +676,13 @@ Provide a brief summary of each recommended package, including its name, ID, dur
                 logging.info(f"Detected area: {area}")
 
                 # Try to detect city and country from locations
-                city, country = detect_city_country(locations)
+                city, country = await run_blocking(detect_city_country, locations)
                 if city or country:
-                    restaurants_info = get_restaurants(area=area, city=city, country=country, cuisine=cuisine)
+                    restaurants_info = await run_blocking(get_restaurants, area=area, city=city, country=country, cuisine=cuisine)
                     bot_reply = restaurants_info
                 else:
                     # If city and country cannot be determined, proceed with area only
-                    restaurants_info = get_restaurants(area=area, cuisine=cuisine)
+                    restaurants_info = await run_blocking(get_restaurants, area=area, cuisine=cuisine)
                     bot_reply = restaurants_info
             else:
                 bot_reply = "Please specify the area or location for which you want the list of halal restaurants."
@@ -515,7 +691,7 @@ Provide a brief summary of each recommended package, including its name, ID, dur
 
         elif intent == 'restaurant_cuisine_query':
             # Handle restaurant queries with cuisine
-            locations = extract_location(message)
+            locations = await run_blocking(extract_location, message)
             logging.info(f"Extracted locations: {locations}")
 
             # Extract cuisine from the message
@@ -532,13 +708,13 @@ Provide a brief summary of each recommended package, including its name, ID, dur
                 logging.info(f"Detected area: {area}")
 
                 # Try to detect city and country from locations
-                city, country = detect_city_country(locations)
+                city, country = await run_blocking(detect_city_country, locations)
                 if city or country:
-                    restaurants_info = get_restaurants(area=area, city=city, country=country, cuisine=cuisine)
+                    restaurants_info = await run_blocking(get_restaurants, area=area, city=city, country=country, cuisine=cuisine)
                     bot_reply = restaurants_info
                 else:
                     # If city and country cannot be determined, proceed with area only
-                    restaurants_info = get_restaurants(area=area, cuisine=cuisine)
+                    restaurants_info = await run_blocking(get_restaurants, area=area, cuisine=cuisine)
                     bot_reply = restaurants_info
             else:
                 bot_reply = "Please specify the area or location for which you want the list of halal restaurants."
@@ -560,7 +736,7 @@ Provide a brief summary of each recommended package, including its name, ID, dur
         elif intent == 'restaurant_special_request':
             # Handle special requests, e.g., for celebrations
             # Provide recommendations
-            locations = extract_location(message)
+            locations = await run_blocking(extract_location, message)
             logging.info(f"Extracted locations: {locations}")
 
             # Extract cuisine from the message
@@ -576,14 +752,14 @@ Provide a brief summary of each recommended package, including its name, ID, dur
                 area = ', '.join(locations)
                 logging.info(f"Detected area: {area}")
 
-                city, country = detect_city_country(locations)
+                city, country = await run_blocking(detect_city_country, locations)
                 if city and country:
                     # Optionally, filter for restaurants suitable for special occasions
-                    restaurants_info = get_restaurants(area=area, city=city, country=country, cuisine=cuisine)
+                    restaurants_info = await run_blocking(get_restaurants, area=area, city=city, country=country, cuisine=cuisine)
                     bot_reply = f"Here are some recommendations for your special occasion:\n\n{restaurants_info}"
                 else:
                     # If city and country cannot be determined, proceed with area only
-                    restaurants_info = get_restaurants(area=area, cuisine=cuisine)
+                    restaurants_info = await run_blocking(get_restaurants, area=area, cuisine=cuisine)
                     bot_reply = f"Here are some recommendations for your special occasion:\n\n{restaurants_info}"
             else:
                 bot_reply = "Please specify the area or location where you're looking to celebrate."
@@ -608,7 +784,7 @@ Provide a brief summary of each recommended package, including its name, ID, dur
                     break
 
             # Extract date from the message
-            date, message_without_date = extract_date(message_lower)
+            date, message_without_date = await run_blocking(extract_date, message_lower)
             if date:
                 logging.info(f"Extracted date: {date}")
                 message_lower = message_without_date  # Update the message to exclude the date
@@ -616,7 +792,7 @@ Provide a brief summary of each recommended package, including its name, ID, dur
                 date = None  # Will default to today's date in get_prayer_times
 
             # Extract locations from the modified message
-            locations = extract_location(message_lower)
+            locations = await run_blocking(extract_location, message_lower)
             logging.info(f"Extracted locations: {locations}")
 
             if locations:
@@ -624,9 +800,14 @@ Provide a brief summary of each recommended package, including its name, ID, dur
                 area = ' '.join(locations)
                 logging.info(f"Detected area: {area}")
 
-                city, country = detect_city_country([area])
+                # Geocode once and reuse the coordinates for the prayer times lookup
+                location = await run_blocking(detect_location, [area])
+                city, country = (location['city'], location['country']) if location else (None, None)
                 if city and country:
-                    prayer_times = get_prayer_times(city=city, country=country, specific_prayer=specific_prayer, date=date)
+                    prayer_times = await run_blocking(
+                        get_prayer_times, city=city, country=country, specific_prayer=specific_prayer, date=date,
+                        lat=location['lat'], lng=location['lng']
+                    )
                     if specific_prayer:
                         date_str = date.strftime('%Y-%m-%d') if date else 'today'
                         bot_reply = f"🕌The time for **{specific_prayer.capitalize()}** prayer in {city}, {country} on {date_str} is:\n\n⏰**{specific_prayer.capitalize()}**: {prayer_times}"
@@ -650,7 +831,8 @@ Provide a brief summary of each recommended package, including its name, ID, dur
                 arrivalAP = flight_details['arrivalAP']
                 arrivalDateTime = flight_details['arrivalDateTime']
 
-                prayer_times_info = get_inflight_prayer_times(
+                prayer_times_info = await run_blocking(
+                    get_inflight_prayer_times,
                     departureAP=departureAP,
                     departureDateTime=departureDateTime,
                     arrivalAP=arrivalAP,
@@ -681,7 +863,7 @@ Provide a brief summary of each recommended package, including its name, ID, dur
                 else:
                     role = 'user'  # Default to 'user' role
                 conversation_history.append({"role": role, "content": msg.content})
-            bot_reply = generate_response_with_gpt(message, conversation_history)
+            bot_reply = await generate_response_with_gpt(message, conversation_history, stream=stream)
             state['data'] = {}  # Reset state data
             state['last_intent'] = intent
 
@@ -689,20 +871,26 @@ Provide a brief summary of each recommended package, including its name, ID, dur
         logging.error(f"Error handling intent '{intent}': {e}")
         bot_reply = "I'm sorry, something went wrong while processing your request."
 
-    logging.info(f"Bot reply: {bot_reply}")
-
     # Update the last intent
     state['last_intent'] = intent
     # Save the updated state
     conversation_states[request.threadId] = state
 
-    # Save the conversation
-    state['memory'].save_context({"input": message}, {"output": bot_reply})
+    def save_conversation(full_reply):
+        logging.info(f"Bot reply: {full_reply}")
+        # Save the conversation
+        state['memory'].save_context({"input": message}, {"output": full_reply})
+
+    if isinstance(bot_reply, str):
+        save_conversation(bot_reply)
+    else:
+        # Streaming reply, saved once the last token has been sent
+        bot_reply = with_completion(bot_reply, save_conversation)
 
     return {"bot_reply": bot_reply, "threadId": request.threadId}
 
 # Function to generate response with GPT-4, including conversation history
-def generate_response_with_gpt(message, conversation_history):
+async def generate_response_with_gpt(message, conversation_history, stream=False):
     try:
         messages = [
             {
@@ -717,12 +905,12 @@ You are Farah, a helpful, friendly, and informative assistant for Muslim travele
         # Add the current user message
         messages.append({"role": "user", "content": message})
 
-        response = openai.ChatCompletion.create(
+        response = await openai.ChatCompletion.acreate(
             model="gpt-4o",
-            messages=messages
+            messages=messages,
+            stream=stream
         )
-        bot_reply = response['choices'][0]['message']['content']
-        return bot_reply
+        return completion_reply(response, stream)
     except Exception as e:
         logging.error(f"Error generating response with GPT-4: {e}")
         return "I'm sorry, I couldn't process your request at the moment."
@@ -730,75 +918,96 @@ You are Farah, a helpful, friendly, and informative assistant for Muslim travele
 # Chat with file endpoint
 @app.post("/chat_with_file")
 async def chat_with_file(request: ChatMessageRequest):
+    return await handle_idempotent("chat_with_file", request, process_chat_with_file)
+
+# Streaming chat with file endpoint (NDJSON)
+@app.post("/chat_with_file/stream")
+async def chat_with_file_stream(request: ChatMessageRequest):
+    return await stream_idempotent("chat_with_file", request, process_chat_with_file)
+
+async def process_chat_with_file(request, stream=False):
     query = request.message.strip()
 
-    # Check if the input is acceptable
-    if not is_input_acceptable(query):
-        bot_reply = "I'm sorry, but I can't assist with that request."
-        logging.info("User input was flagged by Moderation API.")
-        return {"bot_reply": bot_reply, "threadId": request.threadId}
-
-    # Search the document for relevant content
-    relevant_content = search_all_docs(query)
-
-    if relevant_content and relevant_content.strip():  # Ensure relevant_content is not empty
-        # If document content is found, log and use it
-        logging.info(f"Information retrieved from document: {relevant_content}")
-
-        # Get or initialize the conversation state for this threadId
-        if request.threadId not in conversation_states:
-            conversation_states[request.threadId] = {'last_intent': None, 'data': {}, 'memory': ConversationBufferMemory()}
-        state = conversation_states[request.threadId]
-
-        # Get the conversation history
-        conversation_history = []
-        chat_messages = state['memory'].chat_memory.messages
-        for msg in chat_messages:
-            if isinstance(msg, HumanMessage):
-                role = 'user'
-            elif isinstance(msg, AIMessage):
-                role = 'assistant'
-            else:
-                role = 'user'  # Default to 'user' role
-            conversation_history.append({"role": role, "content": msg.content})
+    state = get_conversation_state(request.threadId)
 
-        # Send the document content along with the query to OpenAI to craft a response
-        messages = [
-            {
-                "role": "system",
-                "content": """
+    # Moderate, search the documents and classify the intent (for the /chat fallback) at
+    # the same time; whichever results turn out not to be needed are cancelled
+    moderation = asyncio.create_task(is_input_acceptable(query))
+    retrieval = asyncio.create_task(search_all_docs(query))
+    classification = asyncio.create_task(classify_intent(query, previous_intent=state['last_intent']))
+
+    def cancel_classification_if_answered(task):
+        # Document answers do not need an intent
+        if not task.cancelled() and task.exception() is None and task.result() and task.result().strip():
+            classification.cancel()
+
+    retrieval.add_done_callback(cancel_classification_if_answered)
+
+    try:
+        # Check if the input is acceptable
+        if not await moderation:
+            return flagged_reply(request)
+
+        # Search the document for relevant content
+        relevant_content = await retrieval
+
+        if not (relevant_content and relevant_content.strip()):
+            # No relevant content found in documents, log it and trigger fallback to /chat
+            logging.info("No relevant information found in documents. Falling back to /chat.")
+            intent = await classification
+
+            # Explicitly call the /chat logic (not the endpoint, so the idempotency key is not reused)
+            return await process_chat(request, stream=stream, moderated=True, intent=intent)
+    finally:
+        cancel_pending(moderation, retrieval, classification)
+
+    # If document content is found, log and use it
+    logging.info(f"Information retrieved from document: {relevant_content}")
+
+    # Get the conversation history
+    conversation_history = []
+    chat_messages = state['memory'].chat_memory.messages
+    for msg in chat_messages:
+        if isinstance(msg, HumanMessage):
+            role = 'user'
+        elif isinstance(msg, AIMessage):
+            role = 'assistant'
+        else:
+            role = 'user'  # Default to 'user' role
+        conversation_history.append({"role": role, "content": msg.content})
+
+    # Send the document content along with the query to OpenAI to craft a response
+    messages = [
+        {
+            "role": "system",
+            "content": """
 You are Farah, a helpful assistant for Muslim travelers on a Muslim-friendly website (Halaltrip.com). Use the provided document as a reference for your response. Cite information directly from the document, and mention that it comes from the provided content. Do not include any information that is not in the document. Use the provided document to answer the user's question as accurately as possible. Answer in a concise manner, well formatted, and make it look appealing. Feel free to use emojis. When answering questions, I want you to sound confident.
 """
-            },
-            {
-                "role": "user",
-                "content": f"The following document is provided as reference:\n\n{relevant_content}"
-            }
-        ]
-        # Add conversation history
-        messages.extend(conversation_history)
-        # Add the current user message
-        messages.append({"role": "user", "content": f"Based on this document, please answer the following question:\n\n{request.message}"})
-
-        logging.info(f"Messages sent to OpenAI API: {messages}")
+        },
+        {
+            "role": "user",
+            "content": f"The following document excerpts are provided as reference:\n\n{relevant_content}"
+        }
+    ]
+    # Add conversation history
+    messages.extend(conversation_history)
+    # Add the current user message
+    messages.append({"role": "user", "content": f"Based on this document, please answer the following question:\n\n{request.message}"})
+
+    logging.info(f"Messages sent to OpenAI API: {messages}")
+
+    # Get a response from OpenAI based on the document
+    response = await openai.ChatCompletion.acreate(
+        model=" gpt-4o",
+        messages=messages,
+        stream=stream
+    )
 
-        # Get a response from OpenAI based on the document
-        response = openai.ChatCompletion.create(
-            model=" gpt-4o",
-            messages=messages
-        )
-        bot_reply = response['choices'][0]['message']['content']
+    def save_conversation(full_reply):
         logging.info("Response generated using document content.")
-
         # Save the conversation
-        state['memory'].save_context({"input": request.message}, {"output": bot_reply})
-
-        return {"bot_reply": bot_reply, "threadId": request.threadId}
+        state['memory'].save_context({"input": request.message}, {"output": full_reply})
 
-    else:
-        # No relevant content found in documents, log it and trigger fallback to /chat
-        logging.info("No relevant information found in documents. Falling back to /chat.")
+    bot_reply = completion_reply(response, stream, save_conversation)
 
-        # Explicitly call the /chat logic
-        response = await chat(request)  # Call the /chat logic
-        return response  # Return the general /chat response
+    return {"bot_reply": bot_reply, "threadId": request.threadId}
@@ -0,0 +1,106 @@
+# moderation.py
+
+import os
+import asyncio
+import hashlib
+import logging
+import openai
+from cache import TTLCache
+
+# Verdicts are cached by content hash, so a message is only sent to the Moderation API once
+MODERATION_CACHE_TTL = int(os.getenv('MODERATION_CACHE_TTL', 24 * 3600))
+MODERATION_CACHE_SIZE = int(os.getenv('MODERATION_CACHE_SIZE', 10000))
+
+# Messages arriving within MODERATION_BATCH_WINDOW_MS of each other share one API call
+MODERATION_BATCH_WINDOW_MS = float(os.getenv('MODERATION_BATCH_WINDOW_MS', 5))
+MODERATION_MAX_BATCH_SIZE = int(os.getenv('MODERATION_MAX_BATCH_SIZE', 32))
+
+# Longest a caller waits for a verdict before giving up (seconds)
+MODERATION_TIMEOUT = float(os.getenv('MODERATION_TIMEOUT', 10))
+
+_verdict_cache = TTLCache(maxsize=MODERATION_CACHE_SIZE, ttl=MODERATION_CACHE_TTL)
+_pending = {}  # content hash -> future for the flagged verdict of a queued or in-flight message
+_batch = []  # (content hash, text) waiting for the next API call
+_flush_timer = None
+_flush_tasks = set()  # Keep references so running flushes are not garbage collected
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def consume_exception(future):
+    # Verdict futures may fail after every waiter has given up; mark the error as seen
+    if not future.cancelled():
+        future.exception()
+
+def release(key, future):
+    # Forget a pending verdict, unless the key has since been queued again
+    if _pending.get(key) is future:
+        del _pending[key]
+
+async def flush_batch(batch):
+    # Moderate a batch of messages in a single call and resolve their futures.
+    # Every future in the batch is settled, whatever happens, so no caller is left waiting.
+    futures = [(key, _pending.get(key)) for key, _ in batch]
+    try:
+        response = await openai.Moderation.acreate(input=[text for _, text in batch])
+        results = response['results']
+        if len(results) != len(batch):
+            raise ValueError(f"Moderation API returned {len(results)} results for {len(batch)} inputs")
+        for (key, future), result in zip(futures, results):
+            flagged = result['flagged']
+            _verdict_cache.set(key, flagged)
+            if future and not future.done():
+                future.set_result(flagged)
+    except Exception as e:
+        logging.error(f"Error moderating {len(batch)} messages: {e}")
+        for key, future in futures:
+            if future and not future.done():
+                future.set_exception(e)
+    finally:
+        for key, future in futures:
+            if future is None:
+                continue
+            if not future.done():
+                future.set_exception(RuntimeError("Moderation batch was interrupted"))
+            release(key, future)
+
+def start_flush():
+    global _batch, _flush_timer
+    if _flush_timer is not None:
+        _flush_timer.cancel()
+        _flush_timer = None
+    if not _batch:
+        return
+    batch, _batch = _batch, []
+    task = asyncio.get_running_loop().create_task(flush_batch(batch))
+    _flush_tasks.add(task)
+    task.add_done_callback(_flush_tasks.discard)
+
+async def is_flagged(text):
+    # Moderation verdict for text, from the cache or the next batched API call
+    global _flush_timer
+    key = content_hash(text)
+    flagged = _verdict_cache.get(key)
+    if flagged is not None:
+        return flagged
+
+    future = _pending.get(key)
+    if future is None:
+        # Not queued or in flight yet
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        future.add_done_callback(consume_exception)
+        _pending[key] = future
+        _batch.append((key, text))
+        if len(_batch) >= MODERATION_MAX_BATCH_SIZE:
+            start_flush()
+        elif _flush_timer is None:
+            _flush_timer = loop.call_later(MODERATION_BATCH_WINDOW_MS / 1000, start_flush)
+    # Shielded so one cancelled (or timed out) caller does not cancel the verdict for everyone else
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), MODERATION_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Let the next caller with this text start a fresh request instead of joining a stuck one
+        release(key, future)
+        logging.error(f"Moderation timed out after {MODERATION_TIMEOUT} seconds")
+        raise
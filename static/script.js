@@ -105,39 +105,19 @@ document.addEventListener("DOMContentLoaded", function () {
     messageInput.value = "";
     document.getElementById("sendMessage").disabled = true;
 
-    // Prepare request body with location data
-    const requestBody = {
-      threadId: threadId || "initial_thread",
-      message: message,
-      latitude: userLatitude,
-      longitude: userLongitude
-    };
-
-    console.log("Sending request with:", requestBody);  // Log the request body
-
-    // Make sure the fetch is using "/chat_with_file"
-    fetch("/chat_with_file", {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-      },
-      body: JSON.stringify(requestBody),
-    })
-      .then((response) => {
-        console.log("Response status:", response.status);  // Log the response status
-        return response.json();
-      })
-      .then((data) => {
-        console.log("Received response:", data);  // Log the response data
-        threadId = data.threadId;  // Assign the threadId returned from the server
-        runAssistant(threadId, message);  // Pass the message to runAssistant
-      })
-      .catch((error) => {
-        console.error("There has been a problem with your fetch operation:", error);
-      });
+    // Send the message once and render the reply
+    runAssistant(threadId || "initial_thread", message);
   });
 });
 
+// Generates a unique id per user message so retries are handled idempotently by the server
+function generateMessageId() {
+  if (window.crypto && window.crypto.randomUUID) {
+    return window.crypto.randomUUID();
+  }
+  return `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+}
+
 function runAssistant(threadId, message) {
   const chat = document.getElementById("chat");
   const sendMessageButton = document.getElementById("sendMessage");
@@ -152,26 +132,28 @@ function runAssistant(threadId, message) {
   const requestBody = {
     threadId: threadId,
     message: message,
+    messageId: generateMessageId(),
     latitude: userLatitude,
     longitude: userLongitude
   };
 
-  // Make sure the fetch is using "/chat_with_file"
-  fetch("/chat_with_file", {
+  console.log("Sending request with:", requestBody);  // Log the request body
+
+  // Stream the reply from "/chat_with_file/stream" and render tokens as they arrive
+  fetch("/chat_with_file/stream", {
     method: "POST",
     headers: {
       "Content-Type": "application/json",
     },
     body: JSON.stringify(requestBody),
   })
-    .then((response) => response.json())
-    .then((data) => {
-      console.log(data);
-      // Replace loader with the bot's response
-      var converter = new showdown.Converter();
-      converter.addExtension(linkTargetBlankExtension);
-      const botReplyHtml = converter.makeHtml(data.bot_reply);
-      loaderDiv.innerHTML = botReplyHtml;
+    .then((response) => {
+      if (!response.ok || !response.body) {
+        throw new Error(`Unexpected response status: ${response.status}`);
+      }
+      return readReplyStream(response.body, loaderDiv);
+    })
+    .then(() => {
       sendMessageButton.disabled = false;
       chat.scrollTop = chat.scrollHeight; // Scroll to bottom
     })
@@ -182,29 +164,50 @@ function runAssistant(threadId, message) {
     });
 }
 
-function continueChat(message) {
-  displayMessage('right', message);
+// Reads newline-delimited JSON events ({"delta"}, {"done"} or {"error"}) and renders
+// the accumulated Markdown into the bubble after every chunk
+async function readReplyStream(body, bubbleDiv) {
+  const chat = document.getElementById("chat");
+  const reader = body.getReader();
+  const decoder = new TextDecoder();
+  var converter = new showdown.Converter();
+  converter.addExtension(linkTargetBlankExtension);
+  let buffer = "";
+  let botReply = "";
 
-  // Prepare request body with location data
-  const requestBody = {
-    threadId: threadId,
-    message: message,
-    latitude: userLatitude,
-    longitude: userLongitude
-  };
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+    const lines = buffer.split("\n");
+    buffer = lines.pop();
 
-  fetch("/chat_with_file", {
-    method: "POST",
-    headers: {
-      "Content-Type": "application/json",
-    },
-    body: JSON.stringify(requestBody),
-  })
-    .then((response) => response.json())
-    .then((data) => {
-      runAssistant(threadId, message);  // Use the current message for the assistant response
-    });
+    for (const line of lines) {
+      if (line.trim() === "") {
+        continue;
+      }
+      const event = JSON.parse(line);
+      if (event.delta) {
+        botReply += event.delta;
+      } else if (event.error) {
+        botReply += event.error;
+      }
+    }
+    if (botReply) {
+      bubbleDiv.innerHTML = converter.makeHtml(botReply);
+      chat.scrollTop = chat.scrollHeight; // Scroll to bottom
+    }
+  }
+  console.log("Received response:", botReply);  // Log the full reply
+}
+
+function continueChat(message) {
+  displayMessage('right', message);
 
   document.getElementById("messageInput").value = "";
   document.getElementById("sendMessage").disabled = true;
+
+  runAssistant(threadId, message);
 }
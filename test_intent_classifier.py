@@ -0,0 +1,38 @@
+# test_intent_classifier.py
+
+import os
+import tempfile
+
+# Keep the intent cache's SQLite file out of the working tree
+os.environ.setdefault('CACHE_DIR', tempfile.mkdtemp())
+
+import pytest
+from intent_classifier import classify_intent_locally
+
+# General questions that share words with a data request must be left to GPT
+@pytest.mark.parametrize("message", [
+    "Why are prayer times different in summer?",
+    "Are the prayer times in Dubai accurate?",
+    "What are the prayer times in Dubai based on?",
+    "How is the Qibla direction calculated?",
+    "Does the time for Zuhr change during Ramadan in Jakarta?",
+])
+def test_explanatory_questions_fall_back_to_gpt(message):
+    assert classify_intent_locally(message) is None
+
+@pytest.mark.parametrize("message, intent", [
+    ("Hi", "greeting"),
+    ("What are the prayer times in London", "prayer_time_query"),
+    ("Prayer times in Jakarta", "prayer_time_query"),
+    ("Mosques near me", "mosque_near_me"),
+    ("Show me halal restaurants in Tokyo", "restaurant_query"),
+    ("What is the Qibla direction?", "qibla_direction"),
+])
+def test_unambiguous_requests_are_classified_locally(message, intent):
+    assert classify_intent_locally(message) == intent
+
+def test_ambiguous_requests_fall_back_to_gpt():
+    assert classify_intent_locally("Tell me more about Nasi Lemak House") is None
+
+def test_context_dependent_follow_ups_fall_back_to_gpt():
+    assert classify_intent_locally("Mosques near me", previous_intent='package_query') is None
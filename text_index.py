@@ -0,0 +1,106 @@
+# text_index.py
+
+import re
+import difflib
+from collections import defaultdict
+
+def tokenize(text):
+    # Lowercase word tokens; punctuation such as commas and hyphens separates words
+    return re.findall(r'\w+', (text or '').lower())
+
+class InvertedIndex:
+    # Token-level inverted index over cached records. Each named field group maps to
+    # posting lists of record positions, e.g. {'area': ('name', 'address')}.
+    def __init__(self, records, field_groups):
+        self.records = records
+        self._postings = {}
+        for group, fields in field_groups.items():
+            postings = defaultdict(set)
+            for idx, record in enumerate(records):
+                for field in fields:
+                    for token in tokenize(record.get(field, '')):
+                        postings[token].add(idx)
+            self._postings[group] = dict(postings)
+
+    def lookup(self, group, text):
+        # Positions of records whose group contains every token of text, or None if text has no tokens
+        tokens = set(tokenize(text))
+        if not tokens:
+            return None
+        postings = self._postings[group]
+        posting_lists = sorted((postings.get(token, set()) for token in tokens), key=len)
+        # Intersect starting from the shortest posting list
+        result = set(posting_lists[0])
+        for posting_list in posting_lists[1:]:
+            if not result:
+                break
+            result &= posting_list
+        return result
+
+    def search(self, **criteria):
+        # Records matching all criteria (group=text), in catalog order.
+        # Criteria whose text has no tokens are ignored; with no usable criteria every record matches.
+        result = None
+        for group, text in criteria.items():
+            if not text:
+                continue
+            matches = self.lookup(group, text)
+            if matches is None:
+                continue
+            result = matches if result is None else result & matches
+        if result is None:
+            return list(self.records)
+        return [self.records[idx] for idx in sorted(result)]
+
+def trigrams(text):
+    # Character trigrams of a padded string, so short names still produce some
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class NameIndex:
+    # Name lookup index over cached records: exact and case-insensitive dicts, plus a
+    # trigram index that narrows fuzzy matching to a handful of candidate names.
+    def __init__(self, records, field, max_candidates=100):
+        self.records = records
+        self.max_candidates = max_candidates
+        self._exact = defaultdict(list)  # stripped name -> record positions
+        self._normalized = defaultdict(list)  # lowercase stripped name -> record positions
+        self._trigrams = defaultdict(set)  # trigram -> lowercase names containing it
+        for idx, record in enumerate(records):
+            name = (record.get(field) or '').strip()
+            self._exact[name].append(idx)
+            self._normalized[name.lower()].append(idx)
+        for name in self._normalized:
+            for trigram in trigrams(name):
+                self._trigrams[trigram].add(name)
+        self._trigram_counts = {name: len(trigrams(name)) for name in self._normalized}
+
+    def exact(self, name):
+        # Records whose stripped name equals name exactly
+        return [self.records[idx] for idx in self._exact.get(name, [])]
+
+    def normalized(self, name):
+        # Records whose name equals name ignoring case and surrounding whitespace
+        return [self.records[idx] for idx in self._normalized.get(name.strip().lower(), [])]
+
+    def close_matches(self, name, n=5, cutoff=0.8):
+        # difflib.get_close_matches restricted to the names sharing the most trigrams
+        # with the query; names that close share most of their trigrams anyway
+        query = name.strip().lower()
+        query_trigrams = trigrams(query)
+        shared = defaultdict(int)
+        for trigram in query_trigrams:
+            for candidate in self._trigrams.get(trigram, ()):
+                shared[candidate] += 1
+        # Rank by Dice coefficient so long names sharing many trigrams do not crowd out close ones
+        candidates = sorted(
+            shared,
+            key=lambda candidate: 2 * shared[candidate] / (len(query_trigrams) + self._trigram_counts[candidate]),
+            reverse=True
+        )[:self.max_candidates]
+        return difflib.get_close_matches(query, candidates, n=n, cutoff=cutoff)
+
+    def records_named(self, names):
+        # Records whose lowercase name is in names, in catalog order
+        positions = sorted(idx for name in set(names) for idx in self._normalized.get(name, []))
+        return [self.records[idx] for idx in positions]